@@ -5,6 +5,50 @@ class Config:
     SECRET_KEY = os.getenv('JWT_SECRET')
     SQLALCHEMY_DATABASE_URI = os.getenv('DB_URI_LOCAL')
     SQLALCHEMY_TRACK_MODIFICATIONS = True
+    JSON_SERIALIZER = os.getenv('JSON_SERIALIZER') or 'orjson'
+
+    # Metrics; a directory shared by every worker on the host aggregates them into one /metrics view
+    METRICS_DIR = os.getenv('METRICS_DIR') or None
+    METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS') or 5)
+    # Files not rewritten for this long belong to processes that are gone; well above the flush interval
+    METRICS_STALE_SECONDS = float(os.getenv('METRICS_STALE_SECONDS') or 60)
+    # Bearer token /metrics requires; unset disables the endpoint
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN') or None
+
+    # Response compression
+    COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE') or 1024)
+    COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL') or 6)
+    COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY') or 4)
+
+    # Passwords
+    PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:150000'
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING') or 64)
+
+    # Recommender
+    RECOMMENDER_SCHEDULE = os.getenv('RECOMMENDER_SCHEDULE') or '*/15 * * * *'
+    RECOMMENDER_SCHEDULE_JITTER_SECONDS = float(os.getenv('RECOMMENDER_SCHEDULE_JITTER_SECONDS') or 60)
+    RECOMMENDER_INCREMENTAL = os.getenv('RECOMMENDER_INCREMENTAL', 'true').lower() == 'true'
+    RECOMMENDER_REFACTORIZE_INTERVAL_HOURS = float(os.getenv('RECOMMENDER_REFACTORIZE_INTERVAL_HOURS') or 24)
+    RECOMMENDER_DRIFT_THRESHOLD = float(os.getenv('RECOMMENDER_DRIFT_THRESHOLD') or 0.1)
+    RECOMMENDER_WORKERS = int(os.getenv('RECOMMENDER_WORKERS') or 1)
+    RECOMMENDER_SHARD_SIZE = int(os.getenv('RECOMMENDER_SHARD_SIZE') or 10000)
+    RECOMMENDER_MODEL_DIR = os.getenv('RECOMMENDER_MODEL_DIR') or 'models'
+
+    # Visits
+    VISITS_PAGE_SIZE = int(os.getenv('VISITS_PAGE_SIZE') or 10)
+    VISITS_MAX_PAGE_SIZE = int(os.getenv('VISITS_MAX_PAGE_SIZE') or 100)
+    VISITS_BATCH_CHUNK_SIZE = int(os.getenv('VISITS_BATCH_CHUNK_SIZE') or 500)
+
+    # Business enrichment
+    BUSINESS_REFRESH_SCHEDULE = os.getenv('BUSINESS_REFRESH_SCHEDULE') or '* * * * *'
+    BUSINESS_REFRESH_JITTER_SECONDS = float(os.getenv('BUSINESS_REFRESH_JITTER_SECONDS') or 10)
+    BUSINESS_REFRESH_BATCH_SIZE = int(os.getenv('BUSINESS_REFRESH_BATCH_SIZE') or 100)
+    BUSINESS_MAX_AGE_DAYS = float(os.getenv('BUSINESS_MAX_AGE_DAYS') or 7)
+    # Visit ids read per range when looking for yelp_ids without a business row
+    BUSINESS_REFRESH_SCAN_SIZE = int(os.getenv('BUSINESS_REFRESH_SCAN_SIZE') or 10000)
+    # Batch calls may queue up to YELP_BATCH_WAIT for rate limit tokens, so allow well beyond the interactive fan-out deadline
+    BUSINESS_REFRESH_TIMEOUT_SECONDS = float(os.getenv('BUSINESS_REFRESH_TIMEOUT_SECONDS') or 60)
 
 class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.getenv('DB_URI_TEST') or Config.SQLALCHEMY_DATABASE_URI
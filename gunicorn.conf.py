@@ -0,0 +1,43 @@
+import multiprocessing
+import os
+
+# Production serving: `gunicorn -c gunicorn.conf.py run:scout`
+bind = '0.0.0.0:{}'.format(os.getenv('PORT') or 3000)
+workers = int(os.getenv('WEB_CONCURRENCY') or multiprocessing.cpu_count() * 2 + 1)
+threads = int(os.getenv('WEB_THREADS') or 4)
+worker_class = 'gthread'
+timeout = int(os.getenv('WEB_TIMEOUT') or 30)
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT') or 30)
+keepalive = int(os.getenv('WEB_KEEPALIVE') or 5)
+max_requests = int(os.getenv('WEB_MAX_REQUESTS') or 0)
+max_requests_jitter = int(os.getenv('WEB_MAX_REQUESTS_JITTER') or 0)
+
+# Import the app once in the master so workers share its pages copy-on-write.
+# HUP restarts workers gracefully; deploy new code with USR2 (new master) followed by QUIT to the old one.
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Connections opened while preloading must not be shared between workers
+    from scout import db
+    from run import scout
+
+    with scout.app_context():
+        db.engine.dispose()
+
+
+def worker_exit(server, worker):
+    from scout.lib import metrics
+    from run import scout
+
+    if scout.config['METRICS_DIR']:
+        metrics.flush(scout.config['METRICS_DIR'])
+
+
+def child_exit(server, worker):
+    # Fold the exited worker's metrics into the archive so counters stay monotonic across restarts
+    from scout.lib import metrics
+    from run import scout
+
+    if scout.config['METRICS_DIR']:
+        metrics.archive(scout.config['METRICS_DIR'], worker.pid)
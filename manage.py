@@ -1,7 +1,18 @@
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from uuid import uuid4
+from flask import jsonify
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from scout import db
+from scout.lib import schedules
+from scout.lib.hashing import PasswordHasher
+from scout.lib.serialization import SERIALIZERS, encode_envelope
+from scout.models import Business, Visit
 from run import scout
 
 migrate = Migrate(scout, db)
@@ -9,5 +20,74 @@ migrate = Migrate(scout, db)
 manager = Manager(scout)
 manager.add_command('db', MigrateCommand)
 
+@manager.command
+def run_scheduler():
+    """Runs the recommendation and business refresh jobs, separately from the web workers"""
+    schedules.init()
+
+@manager.command
+def create_recommendations():
+    """Runs the recommender once, e.g. from cron, under the same lock and skip rules as the scheduler"""
+    # A one-shot process holds no factorization to fold visits into, so it always runs in full
+    schedules.refresh_recommendations(incremental=False)
+
+@manager.option('-n', '--logins', dest='logins', type=int, default=200)
+@manager.option('-w', '--workers', dest='workers', type=int, default=None)
+def benchmark_hashing(logins, workers):
+    """Reports password verifications (logins) per second and per core"""
+    workers = workers or os.cpu_count()
+    hasher = PasswordHasher(method=scout.config['PASSWORD_HASH_METHOD'], workers=workers, max_pending=logins)
+    password_hash = hasher.hash('benchmark-password')
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers * 2) as threads:
+        list(threads.map(lambda _: hasher.verify(password_hash, 'benchmark-password'), range(logins)))
+    elapsed = time.perf_counter() - start
+
+    print('{} logins with {} in {:.2f} seconds'.format(logins, scout.config['PASSWORD_HASH_METHOD'], elapsed))
+    print('{:.1f} logins/sec, {:.1f} logins/sec per core ({} workers)'.format(logins / elapsed, logins / elapsed / workers, workers))
+
+@manager.option('-n', '--rows', dest='rows', type=int, default=1000)
+@manager.option('-r', '--repeat', dest='repeat', type=int, default=100)
+def benchmark_serialization(rows, repeat):
+    """Times a GET /visits sized response through jsonify and through each fast serializer"""
+    now = datetime.utcnow()
+    Row = namedtuple('Row', Visit.JSON_FIELDS + ['id', 'business_id', 'business_name', 'business_fetched_at'])
+    records = [Row(uuid4(), 'yelp-{}'.format(i), 1, now, i % 5 + 1, now, now, i, 'yelp-{}'.format(i), 'Place {}'.format(i), now)
+               for i in range(rows)]
+
+    visits = []
+    for record in records:
+        visit = Visit(yelp_id=record.yelp_id, user_id=record.user_id, satisfaction=record.satisfaction, attend_date=record.attend_date)
+        visit.uuid, visit.created_at, visit.updated_at = record.uuid, record.created_at, record.updated_at
+        visits.append((visit, Business(yelp_id=record.business_id, name=record.business_name)))
+
+    def previous():
+        # Per-model dicts with isoformat() per field, then jsonify
+        data = [{'uuid': visit.uuid, 'yelp_id': visit.yelp_id, 'user_id': visit.user_id,
+                 'attend_date': visit.attend_date.isoformat(), 'satisfaction': visit.satisfaction,
+                 'created_at': visit.created_at.isoformat(), 'updated_at': visit.updated_at.isoformat(),
+                 'data': business.to_json(desired_props=['id', 'name'])} for visit, business in visits]
+        return jsonify({'success': True, 'data': data, 'message': None}).get_data()
+
+    def fast(dumps):
+        # Plain rows with native UUID/datetime handling inside a pre-encoded envelope
+        data = [{**dict(zip(Visit.JSON_FIELDS, row)), 'data': {'id': row.business_id, 'name': row.business_name}}
+                for row in records]
+        return encode_envelope(True, data, None, dumps)
+
+    def measure(fn):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            size = len(fn())
+        return (time.perf_counter() - start) / repeat * 1000, size
+
+    with scout.test_request_context():
+        baseline, size = measure(previous)
+        print('{:<10} {:8.2f} ms/response {:9} bytes'.format('jsonify', baseline, size))
+        for name, dumps in SERIALIZERS.items():
+            elapsed, size = measure(lambda: fast(dumps))
+            print('{:<10} {:8.2f} ms/response {:9} bytes  {:.1f}x'.format(name, elapsed, size, baseline / elapsed))
+
 if __name__ == '__main__':
     manager.run()
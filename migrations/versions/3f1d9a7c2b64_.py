@@ -0,0 +1,40 @@
+"""empty message
+
+Revision ID: 3f1d9a7c2b64
+Revises: 700c1d0fa08e
+Create Date: 2026-10-18 16:02:11.418532
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1d9a7c2b64'
+down_revision = '700c1d0fa08e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('recommendations', sa.Column('day', sa.Date(), nullable=True))
+    op.add_column('recommendations', sa.Column('rank', sa.Integer(), nullable=True))
+
+    # Backfill existing rows; duplicates from earlier runs get ranks past 5 instead of colliding
+    op.execute(
+        "UPDATE recommendations r SET day = s.day, rank = s.rank "
+        "FROM (SELECT id, created_at::date AS day, "
+        "row_number() OVER (PARTITION BY user_id, created_at::date ORDER BY id) AS rank "
+        "FROM recommendations) s "
+        "WHERE r.id = s.id"
+    )
+
+    op.alter_column('recommendations', 'day', existing_type=sa.Date(), nullable=False)
+    op.alter_column('recommendations', 'rank', existing_type=sa.Integer(), nullable=False)
+    op.create_unique_constraint('uq_recommendations_user_id_day_rank', 'recommendations', ['user_id', 'day', 'rank'])
+
+
+def downgrade():
+    op.drop_constraint('uq_recommendations_user_id_day_rank', 'recommendations', type_='unique')
+    op.drop_column('recommendations', 'rank')
+    op.drop_column('recommendations', 'day')
@@ -0,0 +1,25 @@
+"""empty message
+
+Revision ID: b7a95e3d1c20
+Revises: 8e2c4b1f0a93
+Create Date: 2026-10-18 17:12:05.630418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7a95e3d1c20'
+down_revision = '8e2c4b1f0a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_visits_user_id_created_at_id', 'visits',
+                    ['user_id', sa.text('created_at DESC'), sa.text('id DESC')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_visits_user_id_created_at_id', table_name='visits')
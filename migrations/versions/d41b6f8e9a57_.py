@@ -0,0 +1,29 @@
+"""empty message
+
+Revision ID: d41b6f8e9a57
+Revises: b7a95e3d1c20
+Create Date: 2026-10-18 17:40:22.981346
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41b6f8e9a57'
+down_revision = 'b7a95e3d1c20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Fails if existing rows already collide; resolve those accounts before upgrading
+    op.create_index(op.f('ix_users_username'), 'users', ['username'], unique=True)
+    op.drop_index(op.f('ix_users_email'), table_name='users')
+    op.create_index('uq_users_email_lower', 'users', [sa.text('lower(email)')], unique=True)
+
+
+def downgrade():
+    op.drop_index('uq_users_email_lower', table_name='users')
+    op.create_index(op.f('ix_users_email'), 'users', ['email'], unique=False)
+    op.drop_index(op.f('ix_users_username'), table_name='users')
@@ -0,0 +1,30 @@
+"""empty message
+
+Revision ID: e92f3a0c7d15
+Revises: d41b6f8e9a57
+Create Date: 2026-10-18 18:05:49.113270
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e92f3a0c7d15'
+down_revision = 'd41b6f8e9a57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Keep the earliest of any visits already recorded twice for the same place and date
+    op.execute(
+        "DELETE FROM visits v USING visits earlier "
+        "WHERE v.user_id = earlier.user_id AND v.yelp_id = earlier.yelp_id "
+        "AND v.attend_date = earlier.attend_date AND v.id > earlier.id"
+    )
+    op.create_unique_constraint('uq_visits_user_id_yelp_id_attend_date', 'visits', ['user_id', 'yelp_id', 'attend_date'])
+
+
+def downgrade():
+    op.drop_constraint('uq_visits_user_id_yelp_id_attend_date', 'visits', type_='unique')
@@ -2,13 +2,14 @@ from flask import Flask
 from flask_jwt_extended import (JWTManager, jwt_required)
 from flask_sqlalchemy import SQLAlchemy
 
-from scout.utils import compose_json_response
+from scout.utils import compose_json_response, compress_response
+from scout.lib import metrics
 from config import app_config
 
 db = SQLAlchemy()
 
 # import models after db instantiation to avoid circular import
-from scout.models import OperationException, User, Visit
+from scout.models import OperationException, User, Visit, Business
 from scout.lib import YelpFusion
 from scout import api
 
@@ -17,6 +18,8 @@ def create_app(config_name):
     app.config.from_object(app_config[config_name])
     jwt = JWTManager(app)
     db.init_app(app)
+    metrics.init_app(app)
+    app.after_request(compress_response)
 
     # Auth
     @app.route('/auth/signup', methods=['POST'])
@@ -27,6 +30,14 @@ def create_app(config_name):
     def login(*args, **kwargs):
         return api.auth.login(*args, **kwargs)
 
+    @jwt.user_identity_loader
+    def user_identity_loader(user):
+        return api.auth.user_identity_loader(user)
+
+    @jwt.user_claims_loader
+    def user_claims_loader(user):
+        return api.auth.user_claims_loader(user)
+
     @jwt.invalid_token_loader
     def invalid_token_loader(msg):
         return api.auth.invalid_token_loader(msg)
@@ -66,12 +77,28 @@ def create_app(config_name):
     def create_visit(*args, **kwargs):
         return api.visits.create_visit(*args, **kwargs)
 
+    @app.route('/visits/batch', methods=['POST'])
+    @jwt_required
+    def create_visits_batch(*args, **kwargs):
+        return api.visits.create_visits_batch(*args, **kwargs)
+
+    # Businesses
+    @app.route('/businesses/<yelp_id>/similar', methods=['GET'])
+    @jwt_required
+    def get_similar_businesses(yelp_id, *args, **kwargs):
+        return api.businesses.get_similar_businesses(yelp_id, *args, **kwargs)
+
     # Search
     @app.route('/search', methods=['GET'])
     @jwt_required
     def search_businesses(*args, **kwargs):
         return api.search.search_businesses(*args, **kwargs)
 
+    # Metrics
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics(*args, **kwargs):
+        return api.metrics.get_metrics(*args, **kwargs)
+
     # Test
     @app.route('/test', methods=['GET'])
     def generate_fake_data(*args, **kwargs):
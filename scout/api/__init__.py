@@ -2,4 +2,6 @@ from scout.api.auth import *
 from scout.api.users import *
 from scout.api.visits import *
 from scout.api.search import *
+from scout.api.businesses import *
+from scout.api.metrics import *
 from scout.api.test import *
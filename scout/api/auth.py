@@ -1,8 +1,11 @@
+from concurrent.futures import TimeoutError as HashingTimeout
 from flask import request
 from flask_jwt_extended import create_access_token
+from sqlalchemy.exc import SQLAlchemyError
 from datetime import timedelta
 
 from scout.models import OperationException, User
+from scout.lib.hashing import HashingBusy
 from scout.utils import compose_json_response
 
 def login(*args, **kwargs):
@@ -15,12 +18,16 @@ def login(*args, **kwargs):
         if username_or_email and password:
             auth_dict = User.validate_credentials(username_or_email, password)
             if auth_dict['valid']:
-                token = create_access_token(identity=auth_dict['user'].to_json()['uuid'], expires_delta=timedelta(90))
+                token = create_access_token(identity=auth_dict['user'], expires_delta=timedelta(90))
                 response = compose_json_response(success=True, data=token, message=None, code=200)
             else:
                 response = compose_json_response(success=False, data=None, message='Unauthorized', code=401)
         else:
             response = compose_json_response(success=False, data=None, message='Invalid auth credentials', code=400)
+    except (HashingBusy, HashingTimeout):
+        response = compose_json_response(success=False, data=None, message='Too many login attempts, try again later', code=503)
+    except SQLAlchemyError:
+        response = compose_json_response(success=False, data=None, message=None, code=503)
     except KeyError:
         response = compose_json_response(success=False, data=None, message=None, code=400)
 
@@ -32,14 +39,25 @@ def signup(*args, **kwargs):
     try:
         new_user = User(username=data['username'], email=data['email'], password=data['password'])
         new_user.save()
-        token = create_access_token(identity=new_user.uuid, expires_delta=timedelta(30))
+        token = create_access_token(identity=new_user, expires_delta=timedelta(30))
         response = compose_json_response(success=True, data=token, message=None, code=200)
+    except AssertionError as e:
+        response = compose_json_response(success=False, data=None, message=str(e), code=400)
+    except (HashingBusy, HashingTimeout):
+        response = compose_json_response(success=False, data=None, message='Too many signups, try again later', code=503)
     except OperationException:
         response = compose_json_response(success=False, data=None, message=None, code=500)
     except KeyError:
         response = compose_json_response(success=False, data=None, message=None, code=400)
     return response
 
+def user_identity_loader(user):
+    return str(user.uuid)
+
+def user_claims_loader(user):
+    # Immutable claims, so protected endpoints need no user lookup
+    return {'id': user.id}
+
 def invalid_token_loader(_):
     return compose_json_response(success=False, data=None, message="Invalid authorization header", code=401)
 
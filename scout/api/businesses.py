@@ -0,0 +1,12 @@
+from flask import request
+
+from scout.models import Recommendation
+from scout.utils import compose_json_response, execute_with_default
+
+def get_similar_businesses(yelp_id, *args, **kwargs):
+    limit = max(min(execute_with_default(int, 10)(request.args.get('limit')), 10), 1)
+    similar_places = Recommendation.get_similar_places(yelp_id, n=limit)
+
+    if similar_places:
+        return compose_json_response(success=True, data=similar_places, message=None, code=200)
+    return compose_json_response(success=False, data=None, message=None, code=404)
@@ -0,0 +1,51 @@
+import hmac
+from datetime import datetime
+from flask import current_app, request
+
+from scout.lib.metrics import Gauge, metrics_response
+from scout.lib.yelp_fusion import YelpFusion
+from scout.models import RecommendationRun
+from scout.utils import compose_json_response
+
+# Read from recommendation_runs at scrape time, since the recommender runs in the scheduler process
+RECOMMENDER_PHASE_SECONDS = Gauge('scout_recommender_phase_seconds', 'Seconds spent per phase in the last completed recommender run', ['phase'])
+RECOMMENDER_LAST_RUN = Gauge('scout_recommender_last_run_timestamp_seconds', 'Finish time of the last completed recommender run')
+RECOMMENDER_LAST_RUN_RECOMMENDATIONS = Gauge('scout_recommender_last_run_recommendations', 'Recommendations saved by the last completed recommender run')
+RECOMMENDER_RUNS = Gauge('scout_recommender_runs', 'Recorded recommender runs by status', ['status'])
+
+# scope="shared" is the whole API key's budget; scope="process" is only the scraped worker's share of it
+YELP_DAILY_QUOTA_REMAINING = Gauge('scout_yelp_daily_quota_remaining', 'Yelp Fusion calls left in today\'s budget', ['scope'])
+YELP_RATE_LIMIT_TOKENS = Gauge('scout_yelp_rate_limit_tokens', 'Tokens currently in the Yelp Fusion bucket', ['scope'])
+
+def get_metrics(*args, **kwargs):
+    # Scrapers authenticate with 'Authorization: Bearer <METRICS_TOKEN>'; without a token configured the endpoint is off
+    token = current_app.config['METRICS_TOKEN']
+    if not token:
+        return compose_json_response(success=False, data=None, message=None, code=404)
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode('utf8'), 'Bearer {}'.format(token).encode('utf8')):
+        return compose_json_response(success=False, data=None, message='Invalid metrics token', code=401)
+
+    try:
+        for status, count in RecommendationRun.count_by_status():
+            RECOMMENDER_RUNS.set(count, status=status)
+
+        run = RecommendationRun.get_latest_completed()
+        if run:
+            for phase in RecommendationRun.PHASES:
+                RECOMMENDER_PHASE_SECONDS.set(getattr(run, phase + '_seconds') or 0, phase=phase)
+            RECOMMENDER_LAST_RUN.set((run.finished_at - datetime(1970, 1, 1)).total_seconds())
+            RECOMMENDER_LAST_RUN_RECOMMENDATIONS.set(run.recommendations or 0)
+    except:
+        # Request and dependency metrics are still worth serving when the database is unavailable
+        pass
+
+    try:
+        quota = YelpFusion.quota_stats()
+        scope = 'shared' if YelpFusion.shares_rate_limit() else 'process'
+        if quota['daily_remaining'] is not None:
+            YELP_DAILY_QUOTA_REMAINING.set(quota['daily_remaining'], scope=scope)
+        YELP_RATE_LIMIT_TOKENS.set(quota['tokens'], scope=scope)
+    except:
+        pass
+
+    return metrics_response()
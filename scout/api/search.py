@@ -1,6 +1,6 @@
 from flask import request
 
-from scout.lib.yelp_fusion import YelpFusion
+from scout.lib.yelp_fusion import YelpFusion, YelpFusionQuotaExceeded
 from scout.utils import compose_json_response
 
 def search_businesses(*args, **kwargs):
@@ -9,10 +9,11 @@ def search_businesses(*args, **kwargs):
     try:
         q = params.get('q')
         location = params.get('location')
-        print(q, location)
         businesses = YelpFusion.search(term=q, location=location)
 
         response = compose_json_response(success=True, data=businesses, message=None, code=200)
+    except YelpFusionQuotaExceeded:
+        response = compose_json_response(success=False, data=None, message='Search quota exhausted, try again later', code=429)
     except KeyError:
         response = compose_json_response(success=True, data=None, message=None, code=400)
     return response
\ No newline at end of file
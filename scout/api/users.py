@@ -1,7 +1,8 @@
 from flask import request
-from scout.utils import execute_with_default, compose_json_response
-from scout.models import User, Visit, Recommendation
-from scout.lib import YelpFusion
+from datetime import datetime
+from scout.utils import execute_with_default, compose_json_response, is_fresh, make_etag, not_modified, set_validators
+from scout.models import Business, User, Visit, Recommendation
+from scout.lib.yelp_fusion import YelpFusionQuotaExceeded
 
 
 def get_me(*args, **kwargs):
@@ -9,14 +10,27 @@ def get_me(*args, **kwargs):
     return compose_json_response(success=True, data=current_user.to_json(), message=None, code=200)
 
 def get_recommendations(*args, **kwargs):
-    current_user = User.get_current()
+    current_user_id = User.get_current_id()
 
     try:
-        recommendations = [YelpFusion.get_with_id(id=recommendation.yelp_id, desired_props = ["id", "name", "image_url", "is_closed", "location", "url", "price"])
-                           for recommendation in Recommendation.get_latest_5_with_user_id(current_user.id)]
+        day = datetime.utcnow().date()
+        count, updated_at, fetched_at = Recommendation.version_for_user(current_user_id, day)
+        # Only stored recommendations are versioned; the on-the-fly fallback is always sent in full
+        etag = make_etag(current_user_id, day, count, updated_at, fetched_at) if count else None
+        if etag and is_fresh(etag):
+            return not_modified(etag)
+
+        desired_props = ["id", "name", "image_url", "is_closed", "location", "url", "price"]
+        latest = Recommendation.get_latest_5_with_user_id(current_user_id, day=day)
 
+        if latest:
+            recommendations = [business.to_json(desired_props) if business else None for _, business in latest]
+        else:
+            recommendations = Business.get_many(Recommendation.score_for_user(current_user_id), desired_props=desired_props)
 
         response = compose_json_response(success=True, data=recommendations, message=None, code=200)
+        if etag:
+            set_validators(response[0], etag)
     except:
         response = compose_json_response(success=False, data=None, message=None, code=500)
     return response
@@ -34,6 +48,8 @@ def get_places_to_discover(*args, **kwargs):
                 response = compose_json_response(success=True, data=places_to_discover, message=None, code=200)
             else:
                 response = compose_json_response(success=False, data=None, message="No places found for current location", code=400)
+        except YelpFusionQuotaExceeded:
+            response = compose_json_response(success=False, data=None, message="Discover quota exhausted, try again later", code=429)
         except:
             response = compose_json_response(success=False, data=None, message=None, code=500)
     else:
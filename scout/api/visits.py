@@ -1,8 +1,11 @@
-from flask import request
+from flask import Response, current_app, request, stream_with_context
+from dateutil.parser import isoparse
+from datetime import timezone
 
+from scout.lib.serialization import get_serializer
 from scout.models import OperationException, User, Visit
-from scout.utils import compose_json_response, execute_with_default
-from scout.lib import YelpFusion
+from scout.utils import (compose_json_response, decode_cursor, encode_cursor, execute_with_default, is_fresh, iter_json_array,
+                         iter_ndjson, make_etag, not_modified, set_validators)
 
 def get_visit_with_uuid(visit_uuid, *args, **kwargs):
     visit = Visit.get_visit_with_uuid(visit_uuid)
@@ -12,23 +15,40 @@ def get_visit_with_uuid(visit_uuid, *args, **kwargs):
     return compose_json_response(success=False, data=None, message=None, code=404)
 
 def get_visits(*args, **kwargs):
-    page_number = execute_with_default(int, 1)(request.args.get('page'))
-    visits = Visit.get_visits(page=page_number)
+    page_number = execute_with_default(int, None)(request.args.get('page'))
+    limit = min(execute_with_default(int, current_app.config['VISITS_PAGE_SIZE'])(request.args.get('limit')),
+                current_app.config['VISITS_MAX_PAGE_SIZE'])
 
-    def map_visit_to_formatted_json(visit):
-        return {**visit.to_json(), "data": YelpFusion.get_with_id(visit.yelp_id, desired_props=["id", "name"])}
+    try:
+        after = decode_cursor(request.args['after']) if request.args.get('after') else None
+    except ValueError:
+        return compose_json_response(success=False, data=None, message='Invalid cursor', code=400)
 
-    formatted_visits = list(map(map_visit_to_formatted_json, visits))
+    if page_number is not None and page_number < 1:
+        return compose_json_response(success=False, data=None, message='Invalid page', code=400)
 
-    if visits:
-        return compose_json_response(success=True, data=formatted_visits, message=None, code=200)
-    return compose_json_response(success=False, data=None, message=None, code=404)
+    visits = Visit.get_visits(after=after, limit=max(limit, 1), page=page_number)
+    if not visits:
+        return compose_json_response(success=False, data=None, message=None, code=404)
+
+    # Validated by the rows of this page alone, so a 304 costs only the indexed page query and skips serialization
+    etag = make_etag(User.get_current_id(), *((row.id, row.updated_at, row.business_fetched_at) for row in visits))
+    if is_fresh(etag):
+        return not_modified(etag)
+
+    # Rows go straight into the response, without loading Visit and Business instances
+    formatted_visits = [{**dict(zip(Visit.JSON_FIELDS, row)), "data": {"id": row.business_id, "name": row.business_name} if row.business_id else None}
+                        for row in visits]
+
+    body, code = compose_json_response(success=True, data=formatted_visits, message=None, code=200)
+    last_visit = visits[-1]
+    return set_validators(body, etag), code, {'X-Next-Cursor': encode_cursor(last_visit.created_at, last_visit.id)}
 
 def create_visit(*args, **kwargs):
     data = request.get_json()
 
     try:
-        user_id = User.get_current().id
+        user_id = User.get_current_id()
         yelp_id = data['yelp_id']
         attend_date = data['attend_date']
         satisfaction = data['satisfaction']
@@ -39,8 +59,74 @@ def create_visit(*args, **kwargs):
                           satisfaction=satisfaction)
         new_visit.save()
         response = compose_json_response(success=True, data=None, message=None, code=200)
+    except AssertionError as e:
+        response = compose_json_response(success=False, data=None, message=str(e), code=400)
     except OperationException:
         response = compose_json_response(success=False, data=None, message=None, code=500)
     except KeyError:
         response = compose_json_response(success=False, data=None, message=None, code=400)
     return response
+
+def create_visits_batch(*args, **kwargs):
+    # Accepts a JSON array or NDJSON body and streams one NDJSON result line per input row
+    user_id = User.get_current_id()
+    chunk_size = current_app.config['VISITS_BATCH_CHUNK_SIZE']
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        rows = iter_ndjson(request.stream)
+    else:
+        rows = iter_json_array(request.stream)
+
+    def parse_visit(row):
+        if isinstance(row, Exception):
+            raise row
+        yelp_id, satisfaction = row['yelp_id'], row['satisfaction']
+        if not isinstance(yelp_id, str) or not 0 < len(yelp_id) <= 128:
+            raise ValueError('Invalid yelp_id')
+        if not isinstance(satisfaction, int) or isinstance(satisfaction, bool):
+            raise ValueError('Invalid satisfaction')
+
+        attend_date = isoparse(row['attend_date'])
+        if attend_date.tzinfo:
+            attend_date = attend_date.astimezone(timezone.utc).replace(tzinfo=None)
+        return {'user_id': user_id, 'yelp_id': yelp_id, 'satisfaction': satisfaction, 'attend_date': attend_date}
+
+    dumps = get_serializer(current_app.config['JSON_SERIALIZER'])
+
+    def result(index, status, message=None):
+        return dumps({'index': index, 'status': status, 'message': message}) + b'\n'
+
+    def flush(chunk):
+        try:
+            inserted = Visit.batch_insert([visit for _, visit in chunk])
+        except OperationException:
+            for index, _ in chunk:
+                yield result(index, 'error')
+            return
+
+        for index, visit in chunk:
+            key = (visit['user_id'], visit['yelp_id'], visit['attend_date'])
+            if key in inserted:
+                inserted.discard(key)
+                yield result(index, 'created')
+            else:
+                yield result(index, 'duplicate')
+
+    def process():
+        chunk = []
+        try:
+            for index, row in enumerate(rows):
+                try:
+                    chunk.append((index, parse_visit(row)))
+                except (AttributeError, KeyError, TypeError, ValueError, OverflowError) as e:
+                    yield result(index, 'invalid', str(e) if not isinstance(e, KeyError) else 'Missing {}'.format(e))
+
+                if len(chunk) >= chunk_size:
+                    yield from flush(chunk)
+                    chunk = []
+        except ValueError as e:
+            yield result(None, 'invalid', str(e))
+
+        if chunk:
+            yield from flush(chunk)
+
+    return Response(stream_with_context(process()), status=200, mimetype='application/x-ndjson')
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+}
+
+# (minimum, maximum) of minute, hour, day of month, month, day of week
+FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+
+def _parse_field(field, minimum, maximum):
+    values = set()
+    for part in field.split(','):
+        expression, _, step = part.partition('/')
+        if expression == '*':
+            start, stop = minimum, maximum
+        elif '-' in expression:
+            start, stop = (int(bound) for bound in expression.split('-', 1))
+        else:
+            start = int(expression)
+            stop = maximum if step else start
+
+        step = int(step) if step else 1
+        if not minimum <= start <= stop <= maximum or step < 1:
+            raise ValueError('Invalid cron field: {}'.format(field))
+        values.update(range(start, stop + 1, step))
+    return values
+
+
+class CronSchedule:
+    # Standard five-field cron expression (minute hour day-of-month month day-of-week), evaluated in UTC
+    def __init__(self, expression):
+        self.expression = expression
+        fields = ALIASES.get(expression, expression).split()
+        if len(fields) != 5:
+            raise ValueError('Invalid cron expression: {}'.format(expression))
+
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            _parse_field(field, *bounds) for field, bounds in zip(fields, FIELDS))
+        # Both 0 and 7 mean Sunday
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    def _day_matches(self, moment):
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        # Like cron, a restricted day-of-month and day-of-week match if either does
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, moment):
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = datetime(moment.year + moment.month // 12, moment.month % 12 + 1, 1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+
+        raise ValueError('Cron expression never fires: {}'.format(self.expression))
@@ -0,0 +1,25 @@
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash_tile(latitude, longitude, precision=6):
+    # Returns the geohash of the cell containing the point and the cell's centre
+    latitude_range, longitude_range = [-90.0, 90.0], [-180.0, 180.0]
+    geohash, bits, bit_count, even = [], 0, 0, True
+
+    while len(geohash) < precision:
+        value, bounds = (longitude, longitude_range) if even else (latitude, latitude_range)
+        middle = (bounds[0] + bounds[1]) / 2
+        if value >= middle:
+            bits = bits << 1 | 1
+            bounds[0] = middle
+        else:
+            bits = bits << 1
+            bounds[1] = middle
+
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits, bit_count = 0, 0
+
+    return ''.join(geohash), sum(latitude_range) / 2, sum(longitude_range) / 2
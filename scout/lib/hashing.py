@@ -0,0 +1,61 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
+
+
+class HashingBusy(Exception):
+    def __init__(self):
+        print('Password hashing queue is full')
+
+
+def _normalize_method(method):
+    # werkzeug stores 'pbkdf2:<hash>' as 'pbkdf2:<hash>:<iterations>', with its default iterations filled in
+    if not method.startswith('pbkdf2:'):
+        return method
+    hash_name, _, iterations = method[len('pbkdf2:'):].partition(':')
+    return 'pbkdf2:{}:{}'.format(hash_name, int(iterations or 0) or DEFAULT_PBKDF2_ITERATIONS)
+
+
+class PasswordHasher:
+    # Runs PBKDF2 in worker processes so request threads are not starved; workers=0 hashes inline
+    def __init__(self, method='pbkdf2:sha256', workers=0, max_pending=64, timeout=10):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        # werkzeug hashes look like '<method>$<salt>$<hash>'
+        return _normalize_method(password_hash.split('$', 1)[0]) != _normalize_method(self.method)
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise HashingBusy()
+            self.pending += 1
+            if self._executor is None or self._executor_pid != os.getpid():
+                # Created from a request thread, so never fork: other threads may hold locks the child would inherit
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('forkserver'))
+                self._executor_pid = os.getpid()
+            executor = self._executor
+
+        try:
+            return executor.submit(fn, *args).result(timeout=self.timeout)
+        finally:
+            with self._lock:
+                self.pending -= 1
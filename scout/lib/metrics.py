@@ -0,0 +1,322 @@
+import bisect
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+ARCHIVE = 'archive.json'
+ARCHIVE_LOCK = 'archive.lock'
+
+# Every metric declared in this process, in declaration order
+_metrics = []
+_last_flush = 0.0
+_heartbeat_pid = None
+_heartbeat_lock = threading.Lock()
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        # collect, if given, returns (labels, value) pairs read from existing stats when the metric is sampled
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        if self.collect is not None:
+            return {self._key(labels): value for labels, value in self.collect()}
+        with self._lock:
+            return {key: list(value) if isinstance(value, list) else value for key, value in self._values.items()}
+
+    def merged(self):
+        # Counters and histograms add up across processes; gauges only when they describe per-process state
+        return self.type != 'gauge' or self.collect is not None
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    # Set gauges are per process and not merged across workers, so only set them from values every process can read,
+    # e.g. the database. Collected gauges describe this process (cache sizes, connections) and are summed
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        # Stored as per-bucket counts, an overflow count and the sum; made cumulative when rendered
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[index] += 1
+            values[-1] += value
+
+
+HTTP_REQUESTS = Counter('scout_http_requests_total', 'HTTP requests by route and status', ['method', 'route', 'status'])
+HTTP_LATENCY = Histogram('scout_http_request_duration_seconds', 'HTTP request latency', ['method', 'route'])
+HTTP_SQL_QUERIES = Histogram('scout_http_request_sql_queries', 'SQL queries issued per HTTP request', ['route'],
+                             buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+HTTP_SQL_SECONDS = Histogram('scout_http_request_sql_seconds', 'Time spent in SQL per HTTP request', ['route'])
+SQL_QUERIES = Counter('scout_sql_queries_total', 'SQL statements executed')
+SQL_LATENCY = Histogram('scout_sql_query_duration_seconds', 'SQL statement latency')
+
+
+def snapshot():
+    return {metric.name: [[list(key), value] for key, value in metric.samples().items()]
+            for metric in _metrics if metric.merged()}
+
+
+def _merge(into, samples):
+    for name, series in samples.items():
+        merged = into.setdefault(name, {})
+        for key, value in series:
+            key = tuple(key)
+            if key not in merged:
+                merged[key] = value
+            elif isinstance(value, list):
+                if len(value) == len(merged[key]):
+                    merged[key] = [a + b for a, b in zip(merged[key], value)]
+            else:
+                merged[key] += value
+
+
+def _write(path, samples):
+    staging = '{}.{}'.format(path, threading.get_ident())
+    with open(staging, 'w') as f:
+        json.dump(samples, f)
+    os.replace(staging, path)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _process_file(pid=None):
+    return '{}-{}.json'.format(socket.gethostname(), os.getpid() if pid is None else pid)
+
+
+def flush(directory):
+    # One file per process, so every worker on the host (and the scheduler) contributes to /metrics
+    os.makedirs(directory, exist_ok=True)
+    global _last_flush
+    _write(os.path.join(directory, _process_file()), snapshot())
+    _last_flush = time.monotonic()
+
+
+def start_heartbeat(directory, interval):
+    # Flushes on a timer too, so an idle process keeps its file fresh and is never taken for an exited one
+    global _heartbeat_pid
+    with _heartbeat_lock:
+        if _heartbeat_pid == os.getpid():
+            return
+        _heartbeat_pid = os.getpid()
+
+    def beat():
+        while True:
+            time.sleep(interval)
+            try:
+                flush(directory)
+            except Exception:
+                pass
+
+    threading.Thread(target=beat, name='metrics-heartbeat', daemon=True).start()
+
+
+def _archive_file(directory, path):
+    # Claim the file first, so concurrent archivers never fold the same process in twice
+    claimed = '{}.archiving.{}'.format(path, os.getpid())
+    try:
+        os.rename(path, claimed)
+    except OSError:
+        return
+
+    # Gauges of an exited process no longer describe anything
+    gauges = {metric.name for metric in _metrics if metric.type == 'gauge'}
+    with open(os.path.join(directory, ARCHIVE_LOCK), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        merged = {}
+        _merge(merged, _read(os.path.join(directory, ARCHIVE)))
+        _merge(merged, {name: series for name, series in _read(claimed).items() if name not in gauges})
+        _write(os.path.join(directory, ARCHIVE), {name: [[list(key), value] for key, value in series.items()]
+                                                  for name, series in merged.items()})
+    os.remove(claimed)
+
+
+def archive(directory, pid):
+    # Called by the gunicorn master when a worker exits, so recycled workers do not leave a file each
+    _archive_file(directory, os.path.join(directory, _process_file(pid)))
+
+
+def expire(directory, max_age):
+    # Archives files of processes that stopped without a graceful exit (killed workers, restarted containers)
+    now = time.time()
+    for name in os.listdir(directory):
+        if not name.endswith('.json') or name in (ARCHIVE, _process_file()):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stale = now - os.path.getmtime(path) > max_age
+        except OSError:
+            continue
+        if stale:
+            _archive_file(directory, path)
+
+
+def collect(directory=None, max_age=None):
+    merged = {}
+    if directory:
+        flush(directory)
+        if max_age:
+            expire(directory, max_age)
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                _merge(merged, _read(os.path.join(directory, name)))
+    else:
+        _merge(merged, snapshot())
+    return merged
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    escape = lambda value: value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value not in (float('inf'), float('-inf')) else ('+Inf' if value > 0 else '-Inf')
+
+
+def render(directory=None, max_age=None):
+    merged = collect(directory, max_age)
+    lines = []
+    for metric in _metrics:
+        series = merged.get(metric.name, {}) if metric.merged() else metric.samples()
+        lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+
+        for key, value in sorted(series.items()):
+            if metric.type != 'histogram':
+                lines.append('{}{} {}'.format(metric.name, _format_labels(metric.labelnames, key), _format_value(value)))
+                continue
+
+            if len(value) != len(metric.buckets) + 2:
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float('inf'),), value[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(metric.name, _format_labels(metric.labelnames, key, [('le', _format_value(bound))]), cumulative))
+            lines.append('{}_sum{} {}'.format(metric.name, _format_labels(metric.labelnames, key), _format_value(value[-1])))
+            lines.append('{}_count{} {}'.format(metric.name, _format_labels(metric.labelnames, key), cumulative))
+
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_response():
+    return Response(render(current_app.config['METRICS_DIR'], current_app.config['METRICS_STALE_SECONDS']), content_type=CONTENT_TYPE)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+
+def _handle_error(exception_context):
+    started_at = exception_context.connection.info.get('query_started_at') if exception_context.connection else None
+    if started_at:
+        started_at.pop()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started_at'].pop()
+    SQL_QUERIES.inc()
+    SQL_LATENCY.observe(elapsed)
+    if has_request_context() and hasattr(g, '_metrics_started_at'):
+        g._metrics_sql_queries += 1
+        g._metrics_sql_seconds += elapsed
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _record(status):
+    if getattr(g, '_metrics_recorded', True):
+        return
+    g._metrics_recorded = True
+
+    route = _route()
+    HTTP_REQUESTS.inc(method=request.method, route=route, status=status)
+    HTTP_LATENCY.observe(time.perf_counter() - g._metrics_started_at, method=request.method, route=route)
+    HTTP_SQL_QUERIES.observe(g._metrics_sql_queries, route=route)
+    HTTP_SQL_SECONDS.observe(g._metrics_sql_seconds, route=route)
+
+    directory = current_app.config['METRICS_DIR']
+    if directory:
+        start_heartbeat(directory, current_app.config['METRICS_FLUSH_SECONDS'])
+        if time.monotonic() - _last_flush >= current_app.config['METRICS_FLUSH_SECONDS']:
+            flush(directory)
+
+
+def init_app(app):
+    # Register before other after_request hooks so their time is included in the latency
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+    @app.before_request
+    def start_timer():
+        g._metrics_started_at = time.perf_counter()
+        g._metrics_sql_queries = 0
+        g._metrics_sql_seconds = 0.0
+        g._metrics_recorded = False
+
+    @app.after_request
+    def record_response(response):
+        _record(response.status_code)
+        return response
+
+    @app.teardown_request
+    def record_error(exception):
+        # Unhandled exceptions skip after_request hooks
+        if exception is not None:
+            _record(500)
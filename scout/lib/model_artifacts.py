@@ -0,0 +1,122 @@
+import os
+import shutil
+import numpy as np
+
+from datetime import datetime
+
+CURRENT = 'current'
+
+# Models opened by this process, keyed by artifact directory
+_loaded = {}
+
+
+class ScoringModel:
+    def __init__(self, path):
+        # Memory-mapped read-only, so every worker on the host shares the same pages
+        load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        self.version = os.path.basename(path)
+        self.U = load('U')
+        self.item_factors = load('item_factors')
+        self.user_ids = load('user_ids')
+        self.user_rows = load('user_rows')
+        self.item_ids = load('item_ids')
+        self.sorted_item_ids = load('sorted_item_ids')
+        self.item_rows = load('item_rows')
+        self.similar_items = load('similar_items')
+        self.similar_scores = load('similar_scores')
+        self.rated_indptr = load('rated_indptr')
+        self.rated_indices = load('rated_indices')
+
+    def row_for_user(self, user_id):
+        position = np.searchsorted(self.user_ids, user_id)
+        if position == len(self.user_ids) or self.user_ids[position] != user_id:
+            return None
+        return self.user_rows[position]
+
+    def row_for_item(self, yelp_id):
+        position = np.searchsorted(self.sorted_item_ids, yelp_id)
+        if position == len(self.sorted_item_ids) or self.sorted_item_ids[position] != yelp_id:
+            return None
+        return self.item_rows[position]
+
+    def similar(self, yelp_id, n=10):
+        row = self.row_for_item(yelp_id)
+        # Places folded in after the last full run are not in the index yet
+        if row is None or row >= len(self.similar_items):
+            return []
+        return [{'id': str(self.item_ids[item]), 'similarity': float(score)}
+                for item, score in zip(self.similar_items[row][:n], self.similar_scores[row][:n])]
+
+    def top_n(self, user_id, n=5):
+        row = self.row_for_user(user_id)
+        n = min(n, len(self.item_ids))
+        if row is None or n == 0:
+            return []
+
+        scores = self.U[row] @ self.item_factors
+        scores[self.rated_indices[self.rated_indptr[row]:self.rated_indptr[row + 1]]] = -np.inf
+
+        candidates = np.argpartition(-scores, n - 1)[:n]
+        ranked = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [str(self.item_ids[item]) for item in ranked if np.isfinite(scores[item])]
+
+
+def save(factorization, directory, similar=None, keep=3):
+    version = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    staging = os.path.join(directory, '.' + version)
+    os.makedirs(staging)
+
+    user_ids = np.asarray(factorization.user_index, dtype=np.int64)
+    user_rows = np.argsort(user_ids, kind='stable')
+    item_ids = np.asarray(factorization.item_index, dtype=str)
+    item_rows = np.argsort(item_ids, kind='stable')
+    arrays = {
+        'U': factorization.U,
+        'item_factors': factorization.sigma.reshape(-1, 1) * factorization.Vt,
+        'user_ids': user_ids[user_rows],
+        'user_rows': user_rows,
+        'item_ids': item_ids,
+        'sorted_item_ids': item_ids[item_rows],
+        'item_rows': item_rows,
+        'rated_indptr': factorization.R.indptr,
+        'rated_indices': factorization.R.indices,
+    }
+    # Folded-in versions keep item rows stable, so the previous neighbour index still applies
+    previous = os.path.join(directory, CURRENT, 'similar_items.npy')
+    if similar is not None:
+        arrays['similar_items'], arrays['similar_scores'] = similar
+    elif os.path.exists(previous):
+        for name in ('similar_items', 'similar_scores'):
+            os.link(os.path.realpath(os.path.join(directory, CURRENT, name + '.npy')), os.path.join(staging, name + '.npy'))
+    else:
+        arrays['similar_items'], arrays['similar_scores'] = np.empty((0, 0), dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(staging, name + '.npy'), np.ascontiguousarray(array))
+
+    # Publish the complete version, then swap the symlink readers follow in one rename
+    os.rename(staging, os.path.join(directory, version))
+    link = os.path.join(directory, '.' + CURRENT)
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(version, link)
+    os.replace(link, os.path.join(directory, CURRENT))
+
+    versions = sorted(name for name in os.listdir(directory) if not name.startswith('.') and name != CURRENT)
+    for stale in versions[:-keep]:
+        shutil.rmtree(os.path.join(directory, stale), ignore_errors=True)
+
+    return version
+
+
+def current(directory):
+    try:
+        version = os.readlink(os.path.join(directory, CURRENT))
+    except OSError:
+        return None
+
+    model = _loaded.get(directory)
+    if model is None or model.version != version:
+        model = ScoringModel(os.path.join(directory, version))
+        _loaded[directory] = model
+    return model
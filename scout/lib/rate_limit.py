@@ -0,0 +1,163 @@
+import threading
+import time
+
+from datetime import datetime
+
+INTERACTIVE = 0
+BATCH = 1
+
+GRANTED = 1
+WAIT = 0
+EXHAUSTED = -1
+
+
+class RateLimiter:
+    # Token bucket plus a daily budget; BATCH calls cannot dip into the share reserved for INTERACTIVE ones.
+    # State lives in this process, so every process sharing an API key must get its own share of the limits
+    def __init__(self, rate, burst, daily_quota, batch_reserve=0.2):
+        self.rate = rate
+        self.burst = burst
+        self.daily_quota = daily_quota
+        self.batch_reserve = batch_reserve
+        self.rejected = {INTERACTIVE: 0, BATCH: 0}
+
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._day = datetime.utcnow().date()
+        self._used_today = 0
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+        today = datetime.utcnow().date()
+        if today != self._day:
+            self._day, self._used_today = today, 0
+
+    def _reserved_tokens(self, reserve):
+        # Capped so the bucket, which never holds more than burst tokens, can still grant a call that keeps it
+        return max(min(self.burst * reserve, self.burst - 1), 0)
+
+    def _take(self, reserve):
+        # Returns (GRANTED | WAIT | EXHAUSTED, seconds until a token with the reserve kept is available)
+        with self._lock:
+            self._refill()
+            if self.daily_quota and self.daily_quota - self._used_today <= self.daily_quota * reserve:
+                return EXHAUSTED, 0
+
+            needed = 1 + self._reserved_tokens(reserve)
+            if self._tokens >= needed:
+                self._tokens -= 1
+                self._used_today += 1
+                return GRANTED, 0
+            return WAIT, (needed - self._tokens) / self.rate
+
+    def acquire(self, priority=INTERACTIVE, timeout=0):
+        deadline = time.monotonic() + timeout
+        reserve = self.batch_reserve if priority == BATCH else 0
+
+        while True:
+            status, wait = self._take(reserve)
+            if status == GRANTED:
+                return True
+
+            if status == EXHAUSTED or time.monotonic() + wait > deadline:
+                with self._lock:
+                    self.rejected[priority] += 1
+                return False
+            time.sleep(wait)
+
+    def stats(self):
+        with self._lock:
+            self._refill()
+            return {
+                'tokens': self._tokens,
+                'daily_remaining': self.daily_quota - self._used_today if self.daily_quota else None,
+                'rejected_interactive': self.rejected[INTERACTIVE],
+                'rejected_batch': self.rejected[BATCH],
+            }
+
+
+# KEYS: bucket hash, today's usage counter. ARGV: rate, burst, now, reserved tokens, daily quota, reserved quota.
+# Numbers go back as strings because Redis truncates Lua numbers to integers
+TAKE_SCRIPT = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local needed, quota, quota_reserve = 1 + tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens, updated = tonumber(state[1]) or burst, tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+
+local used = tonumber(redis.call('GET', KEYS[2]) or '0')
+local status, wait = 0, (needed - tokens) / rate
+if quota > 0 and quota - used <= quota_reserve then
+    status, wait = -1, 0
+elseif tokens >= needed then
+    tokens = tokens - 1
+    redis.call('INCR', KEYS[2])
+    redis.call('EXPIRE', KEYS[2], 172800)
+    status, wait = 1, 0
+end
+
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], 3600)
+return {status, tostring(wait)}
+"""
+
+
+class SharedRateLimiter(RateLimiter):
+    # Same limits with the bucket and daily usage kept in Redis, so every process and host spends one budget.
+    # While Redis is unreachable calls are granted by fallback, a RateLimiter holding this process's share
+    def __init__(self, client, key, rate, burst, daily_quota, batch_reserve=0.2, fallback=None, retry_after=5):
+        super().__init__(rate, burst, daily_quota, batch_reserve)
+        self.client = client
+        self.key = key
+        self.fallback = fallback or RateLimiter(rate, burst, daily_quota, batch_reserve)
+        self.retry_after = retry_after
+        self._script = client.register_script(TAKE_SCRIPT)
+        self._redis_down_until = 0
+
+    def _day_key(self):
+        return '{}:used:{}'.format(self.key, datetime.utcnow().date().isoformat())
+
+    def _redis_available(self):
+        return time.monotonic() >= self._redis_down_until
+
+    def _redis_failed(self):
+        # Skip Redis for a while, so an outage costs one socket timeout per retry_after rather than one per call
+        self._redis_down_until = time.monotonic() + self.retry_after
+
+    def _take(self, reserve):
+        if not self._redis_available():
+            return self.fallback._take(reserve)
+        try:
+            status, wait = self._script(keys=[self.key, self._day_key()],
+                                        args=[self.rate, self.burst, time.time(), self._reserved_tokens(reserve),
+                                              self.daily_quota, self.daily_quota * reserve])
+        except Exception:
+            self._redis_failed()
+            return self.fallback._take(reserve)
+        return int(status), float(wait)
+
+    def stats(self):
+        if not self._redis_available():
+            return self._with_rejected(self.fallback.stats())
+        try:
+            tokens, updated = self.client.hmget(self.key, 'tokens', 'updated')
+            used = int(self.client.get(self._day_key()) or 0)
+        except Exception:
+            self._redis_failed()
+            return self._with_rejected(self.fallback.stats())
+
+        tokens = float(tokens) if tokens is not None else float(self.burst)
+        if updated is not None:
+            tokens = min(self.burst, tokens + max(time.time() - float(updated), 0) * self.rate)
+        return self._with_rejected({
+            'tokens': tokens,
+            'daily_remaining': self.daily_quota - used if self.daily_quota else None,
+        })
+
+    def _with_rejected(self, stats):
+        with self._lock:
+            return {**stats, 'rejected_interactive': self.rejected[INTERACTIVE], 'rejected_batch': self.rejected[BATCH]}
@@ -0,0 +1,316 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator, svds
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+
+from scout.lib.timing import phase
+
+# Per-worker view of the factors shared by sharded_top_n
+_shard_state = {}
+
+# Bytes of dense scores and argpartition indices held at once while ranking a block
+BLOCK_MEMORY_BUDGET = 64 * 1024 * 1024
+
+
+def _block_size(n_columns, budget=BLOCK_MEMORY_BUDGET):
+    # Every block row holds a float64 score and an int64 index per column
+    return max(1, budget // (16 * max(n_columns, 1)))
+
+
+def _aggregate(user_codes, item_codes, sums, counts, n_items):
+    # Repeated visits to the same place are averaged, like pivot_table did
+    keys = np.asarray(user_codes, dtype=np.int64) * n_items + np.asarray(item_codes, dtype=np.int64)
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    rows, cols = np.divmod(unique_keys, n_items)
+    sums = np.bincount(inverse, weights=np.asarray(sums, dtype=np.float64))
+    counts = np.bincount(inverse, weights=np.asarray(counts, dtype=np.float64))
+    return rows, cols, sums, counts
+
+
+def _means(sums, counts):
+    return np.divide(sums, counts, out=np.zeros(len(sums)), where=counts > 0)
+
+
+def demeaned_operator(R):
+    # Unrated cells count as 0 in the mean, matching the old fillna(0) matrix
+    n_users, n_items = R.shape
+    user_means = np.asarray(R.sum(axis=1)).ravel() / n_items
+    R_t = R.T.tocsr()
+
+    def matvec(x):
+        x = np.asarray(x).ravel()
+        return R @ x - user_means * x.sum()
+
+    def rmatvec(y):
+        y = np.asarray(y).ravel()
+        return R_t @ y - user_means.dot(y)
+
+    def matmat(X):
+        return R @ X - np.outer(user_means, X.sum(axis=0))
+
+    operator = LinearOperator((n_users, n_items), matvec=matvec, rmatvec=rmatvec,
+                              matmat=matmat, dtype=np.float64)
+    return operator, user_means
+
+
+def factorize(R, k=3):
+    operator, user_means = demeaned_operator(R)
+    U, sigma, Vt = svds(operator, k=k)
+    return U, sigma, Vt, user_means
+
+
+def top_n(R, U, sigma, Vt, n=5, users=None, block_size=None):
+    # Scores are ranked per user, so the user mean offset can be left out
+    users = np.arange(R.shape[0]) if users is None else np.asarray(users)
+    n_items = R.shape[1]
+    n = min(n, n_items)
+    block_size = block_size or _block_size(n_items)
+    item_factors = sigma.reshape(-1, 1) * Vt
+    top_items = np.full((len(users), n), -1, dtype=np.int64)
+    if n == 0:
+        return top_items
+
+    for start in range(0, len(users), block_size):
+        block = users[start:start + block_size]
+        scores = U[block] @ item_factors
+
+        # Mask places the user already rated
+        rated = R[block].tocoo()
+        scores[rated.row, rated.col] = -np.inf
+
+        rows = np.arange(len(block)).reshape(-1, 1)
+        candidates = np.argpartition(scores, -n, axis=1)[:, -n:]
+        order = np.argsort(-scores[rows, candidates], axis=1, kind='stable')
+        ranked = candidates[rows, order]
+        ranked[np.isneginf(scores[rows, ranked])] = -1
+        top_items[start:start + len(block)] = ranked
+
+    return top_items
+
+
+def similar_items(item_factors, n=10, block_size=None):
+    # Exact cosine nearest neighbours over item vectors, computed a block of items at a time
+    vectors = np.asarray(item_factors, dtype=np.float64).T
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms > 0, norms, 1)
+    n_items = len(vectors)
+    n = min(n, n_items - 1)
+    neighbours = np.empty((n_items, max(n, 0)), dtype=np.int64)
+    similarities = np.empty((n_items, max(n, 0)), dtype=np.float32)
+    if n <= 0:
+        return neighbours, similarities
+
+    block_size = block_size or _block_size(n_items)
+    for start in range(0, n_items, block_size):
+        stop = min(start + block_size, n_items)
+        scores = vectors[start:stop] @ vectors.T
+        rows = np.arange(stop - start).reshape(-1, 1)
+        scores[rows.ravel(), np.arange(start, stop)] = -np.inf
+
+        candidates = np.argpartition(scores, -n, axis=1)[:, -n:]
+        order = np.argsort(-scores[rows, candidates], axis=1, kind='stable')
+        neighbours[start:stop] = candidates[rows, order]
+        similarities[start:stop] = scores[rows, neighbours[start:stop]]
+
+    return neighbours, similarities
+
+
+def _share(array):
+    # Imported here, as multiprocessing.shared_memory needs Python 3.8 and only sharded scoring uses it
+    from multiprocessing import shared_memory
+    array = np.ascontiguousarray(array, dtype=np.float64)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=np.float64, buffer=shm.buf)
+    shared[...] = array
+    return shm, shared
+
+
+def _init_shard_worker(U, Vt, sigma, item_index, on_shard):
+    # Forked workers inherit the parent's mapping of the segments, so they neither re-attach them by name nor
+    # register them with a resource tracker; the parent alone unlinks them
+    _shard_state['U'] = U
+    _shard_state['Vt'] = Vt
+    _shard_state['sigma'] = sigma
+    _shard_state['item_index'] = item_index
+    _shard_state['on_shard'] = on_shard
+
+
+def _score_shard(users, user_ids, R_shard, n):
+    timings = {}
+    with phase(timings, 'score'):
+        top_items = top_n(R_shard, _shard_state['U'][users], _shard_state['sigma'], _shard_state['Vt'], n=n)
+        item_index = _shard_state['item_index']
+        ranked = [[item_index[item] for item in items if item >= 0] for items in top_items]
+    with phase(timings, 'persist'):
+        result = _shard_state['on_shard'](user_ids, ranked)
+    return result, timings
+
+
+def sharded_top_n(R, U, sigma, Vt, user_index, item_index, on_shard, n=5, users=None, workers=None, shard_size=10000):
+    # Scores user shards in worker processes; on_shard(user_ids, ranked_yelp_ids) persists each shard.
+    # Returns (on_shard result, {'score': seconds, 'persist': seconds}) per shard
+    users = np.arange(R.shape[0]) if users is None else np.asarray(users)
+    U_shm, U_shared = _share(U)
+    Vt_shm, Vt_shared = _share(Vt)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('fork'),
+                                 initializer=_init_shard_worker,
+                                 initargs=(U_shared, Vt_shared, sigma, np.asarray(item_index), on_shard)) as executor:
+            futures = [executor.submit(_score_shard, shard, np.asarray(user_index[shard]), R[shard], n)
+                       for shard in (users[start:start + shard_size] for start in range(0, len(users), shard_size))]
+            return [future.result() for future in futures]
+    finally:
+        del U_shared, Vt_shared
+        for shm in (U_shm, Vt_shm):
+            shm.close()
+            shm.unlink()
+
+
+def _resize(matrix, shape):
+    # Grows a CSR matrix with empty rows, or a CSC matrix with empty columns, without copying its data
+    major = shape[0] if sparse.isspmatrix_csr(matrix) else shape[1]
+    indptr = np.concatenate([matrix.indptr, np.full(major + 1 - len(matrix.indptr), matrix.indptr[-1])])
+    return type(matrix)((matrix.data, matrix.indices, indptr), shape=shape)
+
+
+class Factorization:
+    def __init__(self, U, sigma, Vt, user_index, item_index, ratings, watermark=None):
+        self.U = U
+        self.sigma = sigma
+        self.Vt = Vt
+        self.user_index = user_index
+        self.item_index = item_index
+        self.watermark = watermark
+
+        # Aggregated (row, col, sum, count) triplets of the fit, sorted by cell, so new visits average correctly
+        self.ratings = ratings
+        self._base = self._ratings_matrix()
+        self._base_columns = None
+        self._base_keys = None
+        self._row_sums = np.asarray(self._base.sum(axis=1)).ravel()
+
+        # (row, col) -> (sum, count) of cells changed by fold-ins, and the matrix of their change in value
+        self._changes = {}
+        self._delta = None
+        self._R = self._base
+
+        self.refactorized_at = datetime.utcnow()
+        self.base_visits = int(ratings[3].sum())
+        self.folded_visits = 0
+
+    @staticmethod
+    def fit(user_ids, yelp_ids, satisfactions, watermark=None, k=3):
+        # yelp_ids may be a Categorical so large histories are never held as one string per visit
+        user_codes, user_index = pd.factorize(user_ids, sort=True)
+        item_codes, item_index = pd.factorize(yelp_ids, sort=True)
+        ratings = _aggregate(user_codes, item_codes, satisfactions, np.ones(len(user_codes)), len(item_index))
+
+        factorization = Factorization(None, None, None, pd.Index(np.asarray(user_index)), pd.Index(np.asarray(item_index)),
+                                      ratings, watermark)
+        factorization.U, factorization.sigma, factorization.Vt, _ = factorize(factorization.R, k=k)
+        return factorization
+
+    @property
+    def shape(self):
+        return len(self.user_index), len(self.item_index)
+
+    @property
+    def R(self):
+        # The whole current matrix, only assembled when every user is scored
+        if self._R is None:
+            self._R = _resize(self._base, self.shape) + self._delta
+        return self._R
+
+    def rated(self, users):
+        # Current rows of the given users, without assembling the whole matrix
+        rows = _resize(self._base, self.shape)[users]
+        return rows if self._delta is None else rows + self._delta[users]
+
+    def drift(self):
+        return self.folded_visits / max(self.base_visits, 1)
+
+    def needs_refactorization(self, max_age, drift_threshold):
+        return datetime.utcnow() - self.refactorized_at >= max_age or self.drift() > drift_threshold
+
+    def fold_in(self, user_ids, yelp_ids, satisfactions, watermark=None):
+        # Costs O(visits folded in since the fit): only the touched cells, rows and columns are read or rebuilt
+        user_ids, yelp_ids = np.asarray(user_ids), np.asarray(yelp_ids)
+        new_users = pd.Index(pd.unique(user_ids)).difference(self.user_index)
+        new_items = pd.Index(pd.unique(yelp_ids)).difference(self.item_index)
+        self.user_index = self.user_index.append(new_users)
+        self.item_index = self.item_index.append(new_items)
+
+        user_codes = self.user_index.get_indexer(user_ids)
+        item_codes = self.item_index.get_indexer(yelp_ids)
+        rows, cols, sums, counts = _aggregate(user_codes, item_codes, satisfactions, np.ones(len(user_codes)), len(self.item_index))
+        previous_sums, previous_counts = self._cells(rows, cols)
+        sums, counts = previous_sums + sums, previous_counts + counts
+
+        self._changes.update(zip(zip(rows.tolist(), cols.tolist()), zip(sums.tolist(), counts.tolist())))
+        self._row_sums = np.concatenate([self._row_sums, np.zeros(len(new_users))])
+        np.add.at(self._row_sums, rows, sums / counts - _means(previous_sums, previous_counts))
+        self._delta = self._changes_matrix()
+        self._R = None
+        user_means = self._row_sums / len(self.item_index)
+
+        k = len(self.sigma)
+        touched_users = np.unique(rows)
+        touched_items = np.unique(cols)
+
+        # Project touched users onto the current item factors: u = (r - mean) V / sigma
+        R_users = self.rated(touched_users)[:, :self.Vt.shape[1]]
+        U = np.vstack([self.U, np.zeros((len(new_users), k))])
+        U[touched_users] = (R_users @ self.Vt.T - np.outer(user_means[touched_users], self.Vt.sum(axis=1))) / self.sigma
+
+        # Project touched places onto the updated user factors: v = (r - mean)' U / sigma
+        if self._base_columns is None:
+            self._base_columns = self._base.tocsc()
+        R_items = (_resize(self._base_columns, self.shape)[:, touched_items] + self._delta.tocsc()[:, touched_items]).T
+        Vt = np.hstack([self.Vt, np.zeros((k, len(new_items)))])
+        Vt[:, touched_items] = ((R_items @ U - user_means @ U) / self.sigma).T
+
+        self.U, self.Vt = U, Vt
+        self.folded_visits += len(user_codes)
+        if watermark is not None:
+            self.watermark = max(watermark, self.watermark) if self.watermark else watermark
+
+        return touched_users
+
+    def _base_cells(self, rows, cols):
+        # (sum, count) of each cell in the fitted ratings, found by binary search over their sorted keys
+        base_rows, base_cols, base_sums, base_counts = self.ratings
+        n_rows, n_cols = self._base.shape
+        if self._base_keys is None:
+            self._base_keys = base_rows * n_cols + base_cols
+        if not len(self._base_keys):
+            return np.zeros(len(rows)), np.zeros(len(rows))
+
+        keys = rows * n_cols + cols
+        positions = np.minimum(np.searchsorted(self._base_keys, keys), len(self._base_keys) - 1)
+        found = (rows < n_rows) & (cols < n_cols) & (self._base_keys[positions] == keys)
+        return np.where(found, base_sums[positions], 0.0), np.where(found, base_counts[positions], 0.0)
+
+    def _cells(self, rows, cols):
+        # (sum, count) each cell currently aggregates, counting earlier fold-ins
+        sums, counts = self._base_cells(rows, cols)
+        for i, cell in enumerate(zip(rows.tolist(), cols.tolist())):
+            if cell in self._changes:
+                sums[i], counts[i] = self._changes[cell]
+        return sums, counts
+
+    def _changes_matrix(self):
+        cells = np.array(list(self._changes), dtype=np.int64).reshape(-1, 2)
+        totals = np.array(list(self._changes.values()), dtype=np.float64).reshape(-1, 2)
+        rows, cols = cells[:, 0], cells[:, 1]
+        changes = totals[:, 0] / totals[:, 1] - _means(*self._base_cells(rows, cols))
+        return sparse.csr_matrix((changes, (rows, cols)), shape=self.shape)
+
+    def _ratings_matrix(self):
+        rows, cols, sums, counts = self.ratings
+        shape = (len(self.user_index), len(self.item_index))
+        return sparse.csr_matrix((sums / counts, (rows, cols)), shape=shape)
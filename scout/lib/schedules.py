@@ -1,14 +1,124 @@
+import random
 import time
-import schedule
-from scout.models import Recommendation
+import traceback
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import text
+
+from scout import db
+from scout.lib import metrics
+from scout.lib.cron import CronSchedule
+from scout.models import Business, Recommendation, RecommendationRun, Visit
+
+# Cluster-wide advisory lock keys, one per job
+RECOMMENDATIONS_LOCK = zlib.crc32(b'scout.recommendations')
+BUSINESSES_LOCK = zlib.crc32(b'scout.businesses')
+
+RECOMMENDER_PHASES = metrics.Histogram('scout_recommender_phase_duration_seconds', 'Recommender run time per phase', ['phase'],
+                                       buckets=(0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+
+
+@contextmanager
+def advisory_lock(key):
+    # Session-level PostgreSQL lock held on a dedicated connection; yields whether this node got it
+    connection = db.engine.connect().execution_options(autocommit=True)
+    acquired = False
+    try:
+        acquired = connection.execute(text('SELECT pg_try_advisory_lock(:key)'), key=key).scalar()
+        yield acquired
+    finally:
+        try:
+            if acquired:
+                connection.execute(text('SELECT pg_advisory_unlock(:key)'), key=key)
+        except Exception:
+            # Never hand a connection that may still hold the lock back to the pool
+            connection.invalidate()
+        connection.close()
+
+
+class Job:
+    def __init__(self, name, fn, schedule, jitter=0):
+        self.name = name
+        self.fn = fn
+        self.schedule = CronSchedule(schedule)
+        self.jitter = jitter
+        self._plan(datetime.utcnow())
+
+    def _plan(self, after):
+        # Jitter spreads replicas that share a schedule, so they do not all race for the lock on the minute
+        self.tick = self.schedule.next_after(after)
+        self.next_run = self.tick + timedelta(seconds=random.uniform(0, self.jitter))
+
+    def run(self):
+        try:
+            self.fn()
+        except Exception:
+            print('Job {} failed'.format(self.name))
+            traceback.print_exc()
+        finally:
+            db.session.remove()
+            if current_app.config['METRICS_DIR']:
+                metrics.flush(current_app.config['METRICS_DIR'])
+            # Ticks missed while running are skipped rather than run back to back
+            self._plan(max(self.tick, datetime.utcnow()))
+
+
+def refresh_recommendations(incremental=None):
+    with advisory_lock(RECOMMENDATIONS_LOCK) as acquired:
+        if not acquired:
+            print('Recommendations are being computed on another node, skipping')
+            return
+
+        watermark = Visit.watermark()
+        if RecommendationRun.is_current(watermark):
+            print('No visits since the last run, skipping recommendations')
+            return
+
+        if incremental is None:
+            incremental = current_app.config['RECOMMENDER_INCREMENTAL']
+        run = RecommendationRun(watermark, incremental=incremental)
+        run.save()
+        timings = {}
+        try:
+            saved = Recommendation.create_recommendations_for_today(incremental=run.incremental, timings=timings)
+        except Exception:
+            db.session.rollback()
+            run.finish('failed', timings)
+            raise
+        run.finish('completed', timings, recommendations=saved)
+        for name, seconds in timings.items():
+            RECOMMENDER_PHASES.observe(seconds, phase=name)
+
+
+def refresh_businesses():
+    with advisory_lock(BUSINESSES_LOCK) as acquired:
+        if not acquired:
+            return
+
+        Business.refresh(batch_size=current_app.config['BUSINESS_REFRESH_BATCH_SIZE'],
+                         max_age=timedelta(days=current_app.config['BUSINESS_MAX_AGE_DAYS']),
+                         timeout=current_app.config['BUSINESS_REFRESH_TIMEOUT_SECONDS'],
+                         scan_size=current_app.config['BUSINESS_REFRESH_SCAN_SIZE'])
 
-def refresh_recommendations_daily():
-    Recommendation.create_recommendations_for_today()
 
 def init():
-    # TODO: every day
-    schedule.every(10).seconds.do(refresh_recommendations_daily)
+    if current_app.config['METRICS_DIR']:
+        metrics.start_heartbeat(current_app.config['METRICS_DIR'], current_app.config['METRICS_FLUSH_SECONDS'])
+
+    jobs = [
+        Job('recommendations', refresh_recommendations, current_app.config['RECOMMENDER_SCHEDULE'],
+            jitter=current_app.config['RECOMMENDER_SCHEDULE_JITTER_SECONDS']),
+        Job('businesses', refresh_businesses, current_app.config['BUSINESS_REFRESH_SCHEDULE'],
+            jitter=current_app.config['BUSINESS_REFRESH_JITTER_SECONDS']),
+    ]
 
     while True:
-        schedule.run_pending()
-        time.sleep(1)
+        for job in jobs:
+            if job.next_run <= datetime.utcnow():
+                job.run()
+
+        # Wake for the next due job, but re-check the wall clock at least every minute
+        wait = (min(job.next_run for job in jobs) - datetime.utcnow()).total_seconds()
+        time.sleep(min(max(wait, 0), 60))
@@ -0,0 +1,58 @@
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+from uuid import UUID
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    # Types the encoders do not know natively; orjson already covers UUID and datetime itself
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, UUID):
+        return str(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def _dumps_json(value):
+    return json.dumps(value, default=_default, separators=(',', ':'), ensure_ascii=False).encode('utf8')
+
+
+def _dumps_orjson(value):
+    return orjson.dumps(value, default=_default)
+
+
+# Each serializer turns a value into UTF-8 encoded JSON bytes
+SERIALIZERS = {'json': _dumps_json}
+if orjson is not None:
+    SERIALIZERS['orjson'] = _dumps_orjson
+
+
+def get_serializer(name=None):
+    # Unknown or unset names fall back to the fastest serializer installed
+    return SERIALIZERS.get(name) or SERIALIZERS.get('orjson') or _dumps_json
+
+
+# Pre-encoded pieces of the {"success", "data", "message"} envelope every endpoint returns
+_ENVELOPE_HEADS = {True: b'{"success":true,"data":', False: b'{"success":false,"data":'}
+_ENVELOPE_MESSAGE = b',"message":'
+_ENVELOPE_TAIL = b'}'
+_NULL = b'null'
+
+
+def encode_envelope(success, data, message, dumps=None):
+    dumps = dumps or get_serializer()
+    return b''.join((
+        _ENVELOPE_HEADS[bool(success)],
+        _NULL if data is None else dumps(data),
+        _ENVELOPE_MESSAGE,
+        _NULL if message is None else dumps(message),
+        _ENVELOPE_TAIL,
+    ))
+
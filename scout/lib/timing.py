@@ -0,0 +1,12 @@
+import time
+from contextlib import contextmanager
+
+
+@contextmanager
+def phase(timings, name):
+    # Adds the wall time of the block to timings[name], so a phase may be timed in several pieces
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
@@ -1,35 +1,172 @@
 import os
+import random
+import threading
+import time
+import traceback
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait
 from urllib.parse import quote
 from urllib import request
 
+from scout.lib.cache import MISSING, TTLCache, SingleFlight
+from scout.lib.geo import geohash_tile
+from scout.lib.metrics import Counter, Gauge, Histogram
+from scout.lib.rate_limit import BATCH, INTERACTIVE, RateLimiter, SharedRateLimiter
+
+YELP_REQUESTS = Counter('scout_yelp_requests_total', 'Yelp Fusion HTTP calls by endpoint and status', ['path', 'status'])
+YELP_LATENCY = Histogram('scout_yelp_request_duration_seconds', 'Yelp Fusion HTTP call latency', ['path'])
+YELP_ERRORS = Counter('scout_yelp_errors_total', 'Yelp Fusion requests that failed after retries', ['path', 'reason'])
+
 class YelpFusionException(Exception):
     def __init__(self):
         print('HTTP request to Yelp Fusion API failed')
 
+class YelpFusionQuotaExceeded(YelpFusionException):
+    def __init__(self):
+        print('Yelp Fusion API quota exhausted')
+
 class YelpFusion:
     config = {
         'API_KEY': os.getenv('YELP_API_KEY') or None,
-        'HOST': 'https://api.yelp.com',
+        'HOST': os.getenv('YELP_HOST') or 'https://api.yelp.com',
         'SEARCH_PATH': '/v3/businesses/search',
         'SEARCH_LIMIT': 10,
         'BUSINESS_PATH': '/v3/businesses/',
+        'FANOUT_WORKERS': int(os.getenv('YELP_FANOUT_WORKERS') or 16),
+        'FANOUT_TIMEOUT': float(os.getenv('YELP_FANOUT_TIMEOUT') or 3),
+        'POOL_SIZE': int(os.getenv('YELP_POOL_SIZE') or 32),
+        'CONNECT_TIMEOUT': float(os.getenv('YELP_CONNECT_TIMEOUT') or 2),
+        'READ_TIMEOUT': float(os.getenv('YELP_READ_TIMEOUT') or 5),
+        'MAX_RETRIES': int(os.getenv('YELP_MAX_RETRIES') or 3),
+        'BACKOFF_BASE': float(os.getenv('YELP_BACKOFF_BASE') or 0.25),
+        'BACKOFF_MAX': float(os.getenv('YELP_BACKOFF_MAX') or 8),
+        'DISCOVER_GEOHASH_PRECISION': int(os.getenv('YELP_DISCOVER_GEOHASH_PRECISION') or 6),
+        'DISCOVER_CACHE_SIZE': int(os.getenv('YELP_DISCOVER_CACHE_SIZE') or 5000),
+        'DISCOVER_CACHE_TTL': int(os.getenv('YELP_DISCOVER_CACHE_TTL') or 5 * 60),
+        'DISCOVER_REFRESH_AHEAD': float(os.getenv('YELP_DISCOVER_REFRESH_AHEAD') or 0.8),
+        'SEARCH_CACHE_SIZE': int(os.getenv('YELP_SEARCH_CACHE_SIZE') or 2000),
+        'SEARCH_CACHE_TTL': int(os.getenv('YELP_SEARCH_CACHE_TTL') or 30),
+        # Limits of the API key. With a Redis URL every process spends one shared budget; otherwise, or while
+        # Redis is unreachable, each process gets 1/RATE_LIMIT_PROCESSES of them (gunicorn workers plus the scheduler)
+        'RATE_LIMIT_PER_SECOND': float(os.getenv('YELP_RATE_LIMIT_PER_SECOND') or 10),
+        'RATE_LIMIT_BURST': int(os.getenv('YELP_RATE_LIMIT_BURST') or 20),
+        'DAILY_QUOTA': int(os.getenv('YELP_DAILY_QUOTA') or 5000),
+        'RATE_LIMIT_REDIS_URL': os.getenv('YELP_RATE_LIMIT_REDIS_URL') or None,
+        'RATE_LIMIT_KEY': os.getenv('YELP_RATE_LIMIT_KEY') or 'yelp:rate_limit',
+        'RATE_LIMIT_PROCESSES': int(os.getenv('YELP_RATE_LIMIT_PROCESSES') or 1),
+        'RATE_LIMIT_REDIS_TIMEOUT': float(os.getenv('YELP_RATE_LIMIT_REDIS_TIMEOUT') or 0.1),
+        'BATCH_RESERVE': float(os.getenv('YELP_BATCH_RESERVE') or 0.2),
+        'INTERACTIVE_WAIT': float(os.getenv('YELP_INTERACTIVE_WAIT') or 0.25),
+        'BATCH_WAIT': float(os.getenv('YELP_BATCH_WAIT') or 30),
     }
 
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    fanout_executor = None
+    discover_cache = TTLCache(maxsize=config['DISCOVER_CACHE_SIZE'], ttl=config['DISCOVER_CACHE_TTL'])
+    refreshing_tiles = set()
+    search_cache = TTLCache(maxsize=config['SEARCH_CACHE_SIZE'], ttl=config['SEARCH_CACHE_TTL'])
+    search_flight = SingleFlight()
+    rate_limiter = None
+
+    # One pooled keep-alive session per process, recreated after a fork
+    session = None
+    session_pid = None
+    session_lock = threading.Lock()
+    counters = {'requests': 0, 'retries': 0, 'failures': 0}
+
     @staticmethod
-    def request(host, path, api_key, url_params=None):
+    def request(host, path, api_key, url_params=None, priority=INTERACTIVE):
         url_params = url_params or {}
         url = '{0}{1}'.format(host, quote(path.encode('utf8')))
         headers = { 'Authorization': 'Bearer {}'.format(api_key) }
+        timeout = (YelpFusion.config['CONNECT_TIMEOUT'], YelpFusion.config['READ_TIMEOUT'])
+        session = YelpFusion._session()
 
-        try:
-            response = requests.request('GET', url, headers=headers, params=url_params)
-            return response.json()
-        except:
-            raise YelpFusionException()
+        wait = YelpFusion.config['BATCH_WAIT'] if priority == BATCH else YelpFusion.config['INTERACTIVE_WAIT']
+        endpoint = YelpFusion._endpoint(path)
+        reason = 'retries_exhausted'
+
+        for attempt in range(YelpFusion.config['MAX_RETRIES'] + 1):
+            if not YelpFusion._rate_limiter().acquire(priority, timeout=wait):
+                YELP_ERRORS.inc(path=endpoint, reason='quota')
+                raise YelpFusionQuotaExceeded()
+
+            YelpFusion._count('requests')
+            start = time.perf_counter()
+            try:
+                response = session.get(url, headers=headers, params=url_params, timeout=timeout)
+            except requests.RequestException:
+                response = None
+            YELP_LATENCY.observe(time.perf_counter() - start, path=endpoint)
+            YELP_REQUESTS.inc(path=endpoint, status=response.status_code if response is not None else 'error')
+
+            if response is not None and response.status_code not in YelpFusion.RETRY_STATUSES:
+                try:
+                    return response.json()
+                except ValueError:
+                    reason = 'invalid_response'
+                    break
+
+            if attempt < YelpFusion.config['MAX_RETRIES']:
+                YelpFusion._count('retries')
+                time.sleep(YelpFusion._backoff(attempt, response))
+
+        YelpFusion._count('failures')
+        YELP_ERRORS.inc(path=endpoint, reason=reason)
+        raise YelpFusionException()
+
+    @staticmethod
+    def _endpoint(path):
+        # Business lookups are labelled by route, not by id, to keep metric cardinality bounded
+        if path != YelpFusion.config['SEARCH_PATH'] and path.startswith(YelpFusion.config['BUSINESS_PATH']):
+            return YelpFusion.config['BUSINESS_PATH'] + '{id}'
+        return path
 
     @staticmethod
-    def search(term = "", location = "", params = {}, limit = 10):
+    def transport_stats():
+        connections = pooled_requests = 0
+        session = YelpFusion.session
+        if session is not None and YelpFusion.session_pid == os.getpid():
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for pool in [pools.get(key) for key in pools.keys()]:
+                    connections += pool.num_connections
+                    pooled_requests += pool.num_requests
+
+        return {**YelpFusion.counters, 'connections': connections, 'pool_reuse': max(pooled_requests - connections, 0)}
+
+    @staticmethod
+    def _session():
+        with YelpFusion.session_lock:
+            if YelpFusion.session is None or YelpFusion.session_pid != os.getpid():
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=YelpFusion.config['POOL_SIZE'])
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                YelpFusion.session, YelpFusion.session_pid = session, os.getpid()
+            return YelpFusion.session
+
+    @staticmethod
+    def _backoff(attempt, response):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), YelpFusion.config['BACKOFF_MAX'])
+            except ValueError:
+                pass
+
+        # Full jitter: uniform over [0, base * 2^attempt], capped
+        return random.uniform(0, min(YelpFusion.config['BACKOFF_MAX'], YelpFusion.config['BACKOFF_BASE'] * 2 ** attempt))
+
+    @staticmethod
+    def _count(counter):
+        with YelpFusion.session_lock:
+            YelpFusion.counters[counter] += 1
+
+    @staticmethod
+    def search(term = "", location = "", params = {}, limit = 10, priority = INTERACTIVE):
         url_params = {
             'term': term.replace(' ', '+'),
             'limit': limit or YelpFusion.config['SEARCH_LIMIT'],
@@ -40,19 +177,61 @@ class YelpFusion:
         if params:
             url_params = params
 
+        key = tuple(sorted((param, str(value).strip().lower()) for param, value in url_params.items()))
+        businesses = YelpFusion.search_cache.get(key)
+        if businesses is not MISSING:
+            return businesses
+
+        def fetch():
+            try:
+                response = YelpFusion.request(YelpFusion.config['HOST'],
+                                          YelpFusion.config['SEARCH_PATH'],
+                                          YelpFusion.config['API_KEY'],
+                                          url_params=url_params,
+                                          priority=priority)
+            except YelpFusionQuotaExceeded:
+                raise
+            except YelpFusionException: # Handle any HTTP errors
+                return None
+
+            businesses = response['businesses'] if 'businesses' in response else []
+            # Cached before the flight ends so late arrivals hit the cache rather than Yelp
+            YelpFusion.search_cache.set(key, businesses)
+            return businesses
+
+        # Identical searches already in flight wait for that call instead of issuing their own
+        return YelpFusion.search_flight.do(key, fetch)
+
+    @staticmethod
+    def search_stats():
+        return {**YelpFusion.search_flight.stats(), 'cache': YelpFusion.search_cache.stats()}
+
+    @staticmethod
+    def discover(current_coords, desired_props = [], open_now = True, **kwargs):
         try:
-            response = YelpFusion.request(YelpFusion.config['HOST'],
-                                      YelpFusion.config['SEARCH_PATH'],
-                                      YelpFusion.config['API_KEY'],
-                                      url_params=url_params)
-            return response['businesses'] if 'businesses' in response else []
-        except YelpFusionException: # Handle any HTTP errors
-            return None
+            latitude, longitude = float(current_coords['latitude']), float(current_coords['longitude'])
+        except (KeyError, TypeError, ValueError):
+            return YelpFusion._discover(current_coords, desired_props, open_now)
+
+        # Everyone inside one geohash tile shares a single search made from the tile's centre
+        tile, center_latitude, center_longitude = geohash_tile(latitude, longitude, YelpFusion.config['DISCOVER_GEOHASH_PRECISION'])
+        key = (tile, open_now, tuple(desired_props))
+        tile_coords = {'latitude': center_latitude, 'longitude': center_longitude}
+
+        cached = YelpFusion.discover_cache.get(key)
+        if cached is not MISSING:
+            fetched_at, places = cached
+            if time.monotonic() - fetched_at > YelpFusion.config['DISCOVER_CACHE_TTL'] * YelpFusion.config['DISCOVER_REFRESH_AHEAD']:
+                YelpFusion._refresh_tile(key, tile_coords, desired_props, open_now)
+            return places
+
+        return YelpFusion._fetch_tile(key, tile_coords, desired_props, open_now)
 
     @staticmethod
-    def discover(current_coords, desired_props = [], **kwargs):
+    def _discover(current_coords, desired_props, open_now, priority=INTERACTIVE):
         get_only_desired_props = lambda place: {desired_prop: place[desired_prop] for desired_prop in desired_props}
-        response = YelpFusion.search(params = {'term': '', 'limit': 10, 'sort_by': 'rating', 'open_now': True, **current_coords})
+        response = YelpFusion.search(params = {'term': '', 'limit': 10, 'sort_by': 'rating', 'open_now': open_now, **current_coords},
+                                     priority=priority)
 
         try:
             if desired_props:
@@ -63,14 +242,121 @@ class YelpFusion:
         return response
 
     @staticmethod
-    def get_with_id(id, desired_props = [], **kwargs):
+    def _fetch_tile(key, tile_coords, desired_props, open_now, priority=INTERACTIVE):
+        places = YelpFusion._discover(tile_coords, desired_props, open_now, priority)
+        if places is not None:
+            YelpFusion.discover_cache.set(key, (time.monotonic(), places))
+        return places
+
+    @staticmethod
+    def _refresh_tile(key, tile_coords, desired_props, open_now):
+        # Hot tiles are refreshed in the background shortly before they expire, at BATCH priority so refreshes
+        # never spend the headroom kept for requests a user is waiting on
+        with YelpFusion.session_lock:
+            if key in YelpFusion.refreshing_tiles:
+                return
+            YelpFusion.refreshing_tiles.add(key)
+
+        def refresh():
+            try:
+                YelpFusion._fetch_tile(key, tile_coords, desired_props, open_now, BATCH)
+            except Exception:
+                # Nothing waits on this future; the cached tile keeps being served until it expires
+                print('Refreshing discover tile {} failed'.format(key[0]))
+                traceback.print_exc()
+            finally:
+                YelpFusion.refreshing_tiles.discard(key)
+
+        YelpFusion._executor().submit(refresh)
+
+    @staticmethod
+    def get_with_id(id, desired_props = [], priority = INTERACTIVE, not_found = None, **kwargs):
+        # Ids Yelp definitely does not know come back as not_found, any other failure as None.
+        # Not cached: API reads are served from the businesses table, and its refresh wants Yelp's current answer
         try:
             response = YelpFusion.request(YelpFusion.config['HOST'],
                                           YelpFusion.config['BUSINESS_PATH'] + id,
-                                          YelpFusion.config['API_KEY'])
-            if desired_props:
-                return {desired_prop: response[desired_prop] for desired_prop in desired_props }
-
-            return response
+                                          YelpFusion.config['API_KEY'],
+                                          priority=priority)
+        except YelpFusionQuotaExceeded:
+            raise
         except YelpFusionException:
             return None
+
+        error = response.get('error')
+        if error:
+            return not_found if error.get('code') == 'BUSINESS_NOT_FOUND' else None
+
+        if desired_props:
+            return {desired_prop: response[desired_prop] for desired_prop in desired_props }
+
+        return response
+
+    @staticmethod
+    def get_many(ids, desired_props = [], timeout = None, priority = INTERACTIVE, not_found = None, **kwargs):
+        # Fetches concurrently; ids still pending at the deadline come back as None
+        executor = YelpFusion._executor()
+        futures = [executor.submit(YelpFusion.get_with_id, id, desired_props, priority, not_found) for id in ids]
+        wait(futures, timeout=YelpFusion.config['FANOUT_TIMEOUT'] if timeout is None else timeout)
+
+        results = []
+        for future in futures:
+            if future.done() and not future.exception():
+                results.append(future.result())
+            else:
+                future.cancel()
+                results.append(None)
+        return results
+
+    @staticmethod
+    def _executor():
+        with YelpFusion.session_lock:
+            if YelpFusion.fanout_executor is None:
+                YelpFusion.fanout_executor = ThreadPoolExecutor(max_workers=YelpFusion.config['FANOUT_WORKERS'])
+            return YelpFusion.fanout_executor
+
+    @staticmethod
+    def quota_stats():
+        return YelpFusion._rate_limiter().stats()
+
+    @staticmethod
+    def _rate_limiter():
+        with YelpFusion.session_lock:
+            if YelpFusion.rate_limiter is None:
+                config = YelpFusion.config
+                processes = max(config['RATE_LIMIT_PROCESSES'], 1)
+                # Two tokens at least, so a BATCH call can take one while the reserve is kept
+                share = RateLimiter(rate=config['RATE_LIMIT_PER_SECOND'] / processes,
+                                    burst=max(config['RATE_LIMIT_BURST'] // processes, 2),
+                                    daily_quota=config['DAILY_QUOTA'] // processes,
+                                    batch_reserve=config['BATCH_RESERVE'])
+                if config['RATE_LIMIT_REDIS_URL']:
+                    import redis
+                    # Short socket timeouts, so an unreachable Redis falls back to the share instead of stalling calls
+                    client = redis.StrictRedis.from_url(config['RATE_LIMIT_REDIS_URL'],
+                                                        socket_connect_timeout=config['RATE_LIMIT_REDIS_TIMEOUT'],
+                                                        socket_timeout=config['RATE_LIMIT_REDIS_TIMEOUT'])
+                    YelpFusion.rate_limiter = SharedRateLimiter(client, config['RATE_LIMIT_KEY'], rate=config['RATE_LIMIT_PER_SECOND'],
+                                                                burst=config['RATE_LIMIT_BURST'], daily_quota=config['DAILY_QUOTA'],
+                                                                batch_reserve=config['BATCH_RESERVE'], fallback=share)
+                else:
+                    YelpFusion.rate_limiter = share
+            return YelpFusion.rate_limiter
+
+    @staticmethod
+    def shares_rate_limit():
+        return bool(YelpFusion.config['RATE_LIMIT_REDIS_URL'])
+
+
+# Per-process cache and transport stats, sampled when metrics are flushed or scraped
+Counter('scout_yelp_search_cache_requests_total', 'Searches by cache result', ['result'],
+        collect=lambda: [({'result': result}, YelpFusion.search_stats()['cache'][stat]) for result, stat in (('hit', 'hits'), ('miss', 'misses'))])
+Counter('scout_yelp_search_flights_total', 'Searches sent upstream or coalesced onto one in flight', ['outcome'],
+        collect=lambda: [({'outcome': outcome}, YelpFusion.search_stats()[outcome]) for outcome in ('issued', 'coalesced')])
+Counter('scout_yelp_transport_total', 'Yelp Fusion transport events', ['event'],
+        collect=lambda: [({'event': event}, YelpFusion.transport_stats()[event]) for event in ('requests', 'retries', 'failures', 'pool_reuse')])
+Gauge('scout_yelp_connections', 'Pooled connections to Yelp Fusion',
+      collect=lambda: [({}, YelpFusion.transport_stats()['connections'])])
+Counter('scout_yelp_rate_limited_total', 'Yelp Fusion calls refused by the rate limiter', ['priority'],
+        collect=lambda: [({'priority': name}, YelpFusion._rate_limiter().rejected[priority])
+                         for name, priority in (('interactive', INTERACTIVE), ('batch', BATCH))])
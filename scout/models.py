@@ -1,18 +1,25 @@
-from flask_jwt_extended import get_jwt_identity
-from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.orm import validates, load_only
-from sqlalchemy import desc
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import current_app, g
+from flask_jwt_extended import get_jwt_claims, get_jwt_identity
+from sqlalchemy.dialects.postgresql import UUID, JSONB, insert
+from sqlalchemy.orm import validates
+from sqlalchemy import and_, desc, func, or_, select, text, tuple_
+from sqlalchemy.exc import IntegrityError
 from email_validator import validate_email, EmailNotValidError
-from scipy.sparse.linalg import svds
 import numpy as np
 import pandas as pd
 
 from datetime import datetime, timedelta
+import csv
+import io
+import socket
+import time
 from uuid import uuid4
 
 from scout import db
-from scout.lib import YelpFusion
+from scout.lib import YelpFusion, model_artifacts, recommender
+from scout.lib.hashing import PasswordHasher
+from scout.lib.rate_limit import BATCH
+from scout.lib.timing import phase
 
 class OperationException(Exception):
     def __init__(self, *args, **kwargs):
@@ -25,11 +32,11 @@ class User(db.Model):
     # Primary
     id = db.Column(db.Integer, primary_key = True)
     uuid = db.Column(UUID(as_uuid=True), index=True, unique=True, default=uuid4, nullable=False)
-    username = db.Column(db.String(45), nullable=False)
+    username = db.Column(db.String(45), index=True, unique=True, nullable=False)
     password = db.Column(db.String(128), nullable=False)
 
     # Contact
-    email = db.Column(db.String(128), index=True, nullable=False)
+    email = db.Column(db.String(128), nullable=False)
     phone_number = db.Column(db.String(15), nullable=True)
     first_name = db.Column(db.String(45), nullable=True)
     last_name = db.Column(db.String(45), nullable=True)
@@ -38,6 +45,13 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    UNIQUE_CONSTRAINT_MESSAGES = {
+        'ix_users_username': 'Username already taken',
+        'uq_users_email_lower': 'Email already taken',
+    }
+
+    _password_hasher = None
+
     def __init__(self, username, email, password, first_name = None, last_name = None, phone_number = None, **kwargs):
         self.username = username
         self.email = email
@@ -54,8 +68,8 @@ class User(db.Model):
             'uuid': self.uuid,
             'email': self.email,
             'username': self.username,
-            'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat(),
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
         }
 
     def save(self):
@@ -63,6 +77,11 @@ class User(db.Model):
             self.updated_at = datetime.utcnow()
             db.session.add(self)
             db.session.commit()
+        except IntegrityError as e:
+            # Uniqueness is enforced by the database so signup needs no SELECT and cannot race
+            db.session.rollback()
+            constraint = getattr(getattr(e.orig, 'diag', None), 'constraint_name', None)
+            raise AssertionError(User.UNIQUE_CONSTRAINT_MESSAGES.get(constraint, 'User already exists'))
         except:
             raise OperationException(self)
 
@@ -72,9 +91,6 @@ class User(db.Model):
         if not username:
             raise AssertionError('No username provided')
 
-        if User.query.filter(User.username == username).first():
-            raise AssertionError('Username already taken')
-
         return username
 
     @validates('email')
@@ -86,9 +102,6 @@ class User(db.Model):
         except EmailNotValidError:
             raise AssertionError('Invalid email format')
 
-        if User.query.filter(User.email == email).first():
-            raise AssertionError('Email already taken')
-
         return email
 
     # Statics
@@ -98,18 +111,47 @@ class User(db.Model):
 
     @staticmethod
     def validate_password_hash(password, hash, **kwargs):
-        return check_password_hash(hash, password)
+        return User.hasher().verify(hash, password)
+
+    @staticmethod
+    def hasher():
+        if User._password_hasher is None:
+            User._password_hasher = PasswordHasher(method=current_app.config['PASSWORD_HASH_METHOD'],
+                                                   workers=current_app.config['PASSWORD_HASH_WORKERS'],
+                                                   max_pending=current_app.config['PASSWORD_HASH_MAX_PENDING'])
+        return User._password_hasher
 
     @staticmethod
     def get_current():
-        return User.get_user_with_uuid(get_jwt_identity())
+        # Loaded at most once per request, and only by callers that need the full row
+        if 'current_user' not in g:
+            g.current_user = User.get_user_with_uuid(get_jwt_identity())
+        return g.current_user
 
     @staticmethod
-    def validate_credentials(username_or_email, password, **kwargs):
+    def get_current_id():
+        # Tokens issued by login/signup carry the internal id; older tokens fall back to a lookup
+        user_id = get_jwt_claims().get('id')
+        if user_id is None:
+            current_user = User.get_current()
+            user_id = current_user.id if current_user else None
+        return user_id
 
-        user = User.query.filter(User.username == username_or_email).first() or \
-               User.query.filter(User.email == username_or_email).first()
+    @staticmethod
+    def validate_credentials(username_or_email, password, **kwargs):
+        # One round trip; a username match wins over another account's email
+        users = User.query.filter(or_(User.username == username_or_email,
+                                      func.lower(User.email) == username_or_email.lower())).limit(2).all()
+        user = next((user for user in users if user.username == username_or_email), users[0] if users else None)
         if user and User.validate_password_hash(password, user.password):
+            # Upgrade hashes made with an older work factor while the plain password is at hand
+            if User.hasher().needs_rehash(user.password):
+                try:
+                    user.password = user._hash_password(password)
+                    user.save()
+                except Exception:
+                    # Keep the old hash and let the login through; the upgrade is retried next time
+                    db.session.rollback()
             return { 'valid': True, 'user': user }
 
         return { 'valid': False, 'user': None }
@@ -126,11 +168,14 @@ class User(db.Model):
 
     # Private
     def _hash_password(self, password):
-        return generate_password_hash(password)
+        return User.hasher().hash(password)
+
+db.Index('uq_users_email_lower', func.lower(User.email), unique=True)
 
 
 class Visit(db.Model):
     __tablename__ = 'visits'
+    __table_args__ = (db.UniqueConstraint('user_id', 'yelp_id', 'attend_date', name='uq_visits_user_id_yelp_id_attend_date'),)
 
     # Primary
     id = db.Column(db.Integer, primary_key=True)
@@ -153,22 +198,19 @@ class Visit(db.Model):
     def __repr__(self):
         return str(self.to_json())
 
+    JSON_FIELDS = ['uuid', 'yelp_id', 'user_id', 'attend_date', 'satisfaction', 'created_at', 'updated_at']
+
     def to_json(self):
-        return {
-            'uuid': self.uuid,
-            'yelp_id': self.yelp_id,
-            'user_id': self.user_id,
-            'attend_date': self.attend_date.isoformat(),
-            'satisfaction': self.satisfaction,
-            'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat(),
-        }
+        return {field: getattr(self, field) for field in Visit.JSON_FIELDS}
 
     def save(self):
         try:
             self.updated_at = datetime.utcnow()
             db.session.add(self)
             db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            raise AssertionError('Visit already recorded')
         except:
             raise OperationException(self)
 
@@ -182,36 +224,120 @@ class Visit(db.Model):
         except:
             raise OperationException(records)
 
+    @staticmethod
+    def batch_insert(records):
+        # Inserts dicts of column values in one statement; returns the (user_id, yelp_id, attend_date) keys actually written
+        now = datetime.utcnow()
+        statement = insert(Visit.__table__).values([{**record, 'uuid': uuid4(), 'created_at': now, 'updated_at': now} for record in records]) \
+                                           .on_conflict_do_nothing(index_elements=['user_id', 'yelp_id', 'attend_date']) \
+                                           .returning(Visit.user_id, Visit.yelp_id, Visit.attend_date)
+        try:
+            inserted = {tuple(row) for row in db.session.execute(statement)}
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise OperationException()
+        return inserted
+
+    @staticmethod
+    def load_history(since=None, chunk_size=100000):
+        # Streams (user_id, yelp_id, satisfaction) through a server-side cursor into preallocated arrays
+        snapshot = select([func.count(Visit.id), func.max(Visit.id), func.max(Visit.created_at)])
+        if since is not None:
+            snapshot = snapshot.where(Visit.created_at > since)
+        total, max_id, watermark = db.session.execute(snapshot).first()
+        if not total:
+            return np.empty(0, dtype=np.int64), pd.Categorical([]), np.empty(0, dtype=np.int32), since
+
+        user_ids = np.empty(total, dtype=np.int64)
+        item_codes = np.empty(total, dtype=np.int64)
+        satisfactions = np.empty(total, dtype=np.int32)
+        item_index = {}
+
+        history = select([Visit.user_id, Visit.yelp_id, Visit.satisfaction]).where(Visit.id <= max_id)
+        if since is not None:
+            history = history.where(Visit.created_at > since)
+
+        loaded = 0
+        with db.engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(history)
+            while loaded < total:
+                rows = result.fetchmany(chunk_size)[:total - loaded]
+                if not rows:
+                    break
+
+                chunk_user_ids, chunk_yelp_ids, chunk_satisfactions = zip(*rows)
+                chunk_codes, chunk_items = pd.factorize(np.array(chunk_yelp_ids, dtype=object))
+                global_codes = np.array([item_index.setdefault(yelp_id, len(item_index)) for yelp_id in chunk_items], dtype=np.int64)
+
+                end = loaded + len(rows)
+                user_ids[loaded:end] = chunk_user_ids
+                item_codes[loaded:end] = global_codes[chunk_codes]
+                satisfactions[loaded:end] = chunk_satisfactions
+                loaded = end
+            result.close()
+
+        yelp_ids = pd.Categorical.from_codes(item_codes[:loaded], categories=list(item_index))
+        return user_ids[:loaded], yelp_ids, satisfactions[:loaded], watermark
+
+    @staticmethod
+    def watermark():
+        # Highest (id, created_at) recorded; unchanged means no visit was added since
+        return tuple(db.session.execute(select([func.max(Visit.id), func.max(Visit.created_at)])).first())
+
     @staticmethod
     def get_visit_with_uuid(visit_uuid):
         return Visit.query.filter(Visit.uuid == visit_uuid).first()
 
     @staticmethod
-    def get_visits(page):
-        current_user = User.get_current()
-        return Visit.query.filter(Visit.user_id == current_user.id).order_by(desc("created_at")).paginate(page, 10, False).items
+    def get_visits(after=None, limit=10, page=None):
+        # Keyset pagination on (created_at, id), served by ix_visits_user_id_created_at_id.
+        # Returns plain rows of Visit.JSON_FIELDS plus id, business_id, business_name and business_fetched_at
+        columns = [getattr(Visit, field) for field in Visit.JSON_FIELDS]
+        query = db.session.query(*columns, Visit.id, Business.yelp_id.label('business_id'), Business.name.label('business_name'),
+                                 Business.fetched_at.label('business_fetched_at')) \
+                          .outerjoin(Business, and_(Business.yelp_id == Visit.yelp_id, Business.found)) \
+                          .filter(Visit.user_id == User.get_current_id())
+
+        if after:
+            query = query.filter(tuple_(Visit.created_at, Visit.id) < after)
+        elif page:
+            query = query.offset((page - 1) * limit)
+
+        return query.order_by(desc(Visit.created_at), desc(Visit.id)).limit(limit).all()
 
     @staticmethod
     def get_places_to_discover(current_coords):
         return YelpFusion.discover(current_coords, desired_props=["name", "image_url", "is_closed", "location", "url", "id", "categories"])
 
+db.Index('ix_visits_user_id_created_at_id', Visit.user_id, Visit.created_at.desc(), Visit.id.desc())
+
 
 class Recommendation(db.Model):
     __tablename__ = 'recommendations'
+    __table_args__ = (db.UniqueConstraint('user_id', 'day', 'rank', name='uq_recommendations_user_id_day_rank'),)
 
     # Primary
     id = db.Column(db.Integer, primary_key=True, nullable=False)
     uuid = db.Column(UUID(as_uuid=True), index=True, unique=True, default=uuid4)
     user_id = db.Column(db.Integer, nullable=False)
     yelp_id = db.Column(db.String(128), nullable=False)
+    day = db.Column(db.Date, nullable=False, default=lambda: datetime.utcnow().date())
+    rank = db.Column(db.Integer, nullable=False)
 
     # Metadata
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    def __init__(self, user_id, yelp_id):
+    # Last factorization kept by the scheduler process for incremental refreshes, and the last day all users were scored
+    _factorization = None
+    _scored_day = None
+
+    def __init__(self, user_id, yelp_id, rank, day=None):
         self.user_id = user_id
         self.yelp_id = yelp_id
+        self.rank = rank
+        self.day = day
 
     def __repr__(self):
         return str(self.to_json())
@@ -221,8 +347,10 @@ class Recommendation(db.Model):
             'uuid': self.uuid,
             'user_id': self.user_id,
             'yelp_id': self.yelp_id,
-            'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat(),
+            'day': self.day,
+            'rank': self.rank,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
         }
 
     def save(self):
@@ -244,56 +372,376 @@ class Recommendation(db.Model):
             raise OperationException(records)
 
     @staticmethod
-    def get_latest_5_with_user_id(user_id):
-        current_date = datetime.utcnow().date()
+    def bulk_upsert(rows):
+        # rows are (user_id, day, rank, yelp_id); rerunning a day replaces it instead of adding duplicates
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        count = 0
+        for user_id, day, rank, yelp_id in rows:
+            writer.writerow((uuid4(), user_id, day.isoformat(), rank, yelp_id))
+            count += 1
+        buffer.seek(0)
+
+        start = time.perf_counter()
+        try:
+            connection = db.session.connection()
+            connection.execute(text(
+                "CREATE TEMP TABLE recommendations_staging "
+                "(uuid uuid, user_id integer, day date, rank integer, yelp_id varchar(128)) ON COMMIT DROP"
+            ))
+            cursor = connection.connection.cursor()
+            cursor.copy_expert("COPY recommendations_staging (uuid, user_id, day, rank, yelp_id) FROM STDIN WITH (FORMAT csv)", buffer)
+            connection.execute(text(
+                "INSERT INTO recommendations (uuid, user_id, day, rank, yelp_id, created_at, updated_at) "
+                "SELECT uuid, user_id, day, rank, yelp_id, timezone('utc', now()), timezone('utc', now()) "
+                "FROM recommendations_staging "
+                "ON CONFLICT (user_id, day, rank) DO UPDATE "
+                "SET yelp_id = EXCLUDED.yelp_id, updated_at = EXCLUDED.updated_at"
+            ))
+            # Drop ranks left over from a previous run that produced more places
+            connection.execute(text(
+                "DELETE FROM recommendations r "
+                "USING (SELECT user_id, day, max(rank) AS max_rank FROM recommendations_staging GROUP BY user_id, day) s "
+                "WHERE r.user_id = s.user_id AND r.day = s.day AND r.rank > s.max_rank"
+            ))
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise OperationException()
+        elapsed = time.perf_counter() - start
+
+        print("Upserted {} recommendations in {:.2f} seconds ({:.0f} rows/sec)".format(count, elapsed, count / elapsed if elapsed else 0))
+        return count
 
-        return Recommendation.query.filter(
-            Recommendation.created_at.between(current_date, current_date + timedelta(days=1)),
+    @staticmethod
+    def save_ranked(user_ids, ranked_yelp_ids):
+        day = datetime.utcnow().date()
+        return Recommendation.bulk_upsert((int(user_id), day, rank, yelp_id)
+                                          for user_id, yelp_ids in zip(user_ids, ranked_yelp_ids)
+                                          for rank, yelp_id in enumerate(yelp_ids, start=1))
+
+    @staticmethod
+    def get_latest_5_with_user_id(user_id, day=None):
+        return Recommendation.query.add_entity(Business).outerjoin(Business, and_(Business.yelp_id == Recommendation.yelp_id, Business.found)).filter(
+            Recommendation.day == (day or datetime.utcnow().date()),
             Recommendation.user_id == user_id,
-        ).limit(5).all()
+        ).order_by(Recommendation.rank).limit(5).all()
+
+    @staticmethod
+    def version_for_user(user_id, day):
+        # (count, last upsert, latest business fetch) of the user's recommendations for day
+        return db.session.query(func.count(Recommendation.id), func.max(Recommendation.updated_at), func.max(Business.fetched_at)) \
+                         .select_from(Recommendation) \
+                         .outerjoin(Business, Business.yelp_id == Recommendation.yelp_id) \
+                         .filter(Recommendation.user_id == user_id, Recommendation.day == day).one()
+
+    @staticmethod
+    def score_for_user(user_id, n=5):
+        # Fresh top-N from the latest persisted model, without touching the recommendations table
+        model = model_artifacts.current(current_app.config['RECOMMENDER_MODEL_DIR'])
+        return model.top_n(user_id, n=n) if model else []
+
+    @staticmethod
+    def get_similar_places(yelp_id, n=10):
+        model = model_artifacts.current(current_app.config['RECOMMENDER_MODEL_DIR'])
+        return model.similar(yelp_id, n=n) if model else []
 
     @staticmethod
-    def create_recommendations_for_today():
-        # Get complete visit history
-        visit_history = Visit.query.options(load_only('user_id', 'yelp_id', 'satisfaction')).all()
-        # Maps query to [('user_id', 'yelp_id', 'satisfaction)] format
-        formatted_visit_history = [(visit.user_id, visit.yelp_id, visit.satisfaction) for visit in visit_history]
-
-        # Initialize Dataframe
-        visit_history_df = pd.DataFrame(formatted_visit_history, columns=['user_id', 'yelp_id', 'satisfaction'])
-        R_df = pd.pivot_table(visit_history_df, index='user_id', columns='yelp_id', values='satisfaction').fillna(0)
-        R = R_df.as_matrix()
-        user_satisfactions_mean = np.mean(R, axis=1)
-        R_demeaned = R - user_satisfactions_mean.reshape(-1, 1)
-
-        U, sigma, Vt = svds(R_demeaned, k=3)
-        sigma = np.diag(sigma)
-        all_user_predicted_ratings = np.dot(np.dot(U, sigma), Vt) + user_satisfactions_mean.reshape(-1, 1)
-        predictions_df = pd.DataFrame(all_user_predicted_ratings, index=R_df.index.values, columns=R_df.columns)
-
-        def create_recommendations_with_user_id(user_id):
-            rated_by_user = np.array(visit_history_df[visit_history_df['user_id'] == user_id]['yelp_id'])
-            recommendations_per_day = 5
-
-            if len(rated_by_user) > 0:
-                predictions = predictions_df.loc[user_id].sort_values(ascending=False).index.values
-                yelp_ids = list(set(predictions) - set(rated_by_user))[:recommendations_per_day]
-
-                recommendations_for_today = [Recommendation(yelp_id=yelp_id, user_id=user_id) for yelp_id in yelp_ids]
+    def create_recommendations_for_today(incremental=False, timings=None):
+        # timings collects seconds spent in each of the load, factorize, score and persist phases
+        recommendations_per_day = 5
+        timings = {} if timings is None else timings
+        factorization = Recommendation._factorization
+        max_age = timedelta(hours=current_app.config['RECOMMENDER_REFACTORIZE_INTERVAL_HOURS'])
+        drift_threshold = current_app.config['RECOMMENDER_DRIFT_THRESHOLD']
+
+        today = datetime.utcnow().date()
+
+        if incremental and factorization and not factorization.needs_refactorization(max_age, drift_threshold):
+            # Fold in only the visits recorded since the last run
+            with phase(timings, 'load'):
+                user_ids, yelp_ids, satisfactions, watermark = Visit.load_history(since=factorization.watermark)
+
+            # Rows are stored per day, so the first run of a day rescores every user from the kept factors
+            new_day = Recommendation._scored_day != today
+            if not len(user_ids) and not new_day:
+                return 0
+
+            users = None
+            if len(user_ids):
+                with phase(timings, 'factorize'):
+                    touched = factorization.fold_in(user_ids, yelp_ids, satisfactions, watermark=watermark)
+                if not new_day:
+                    users = touched
+            similar = None
+        else:
+            # Get complete visit history
+            with phase(timings, 'load'):
+                user_ids, yelp_ids, satisfactions, watermark = Visit.load_history()
+            if not len(user_ids):
+                return 0
+
+            with phase(timings, 'factorize'):
+                factorization = recommender.Factorization.fit(user_ids, yelp_ids, satisfactions, watermark=watermark, k=3)
+                Recommendation._factorization = factorization
+                users = None
+                similar = recommender.similar_items(factorization.sigma.reshape(-1, 1) * factorization.Vt)
+
+        # Full versions are only published on refactorization; a fold-in would rewrite O(history) for an O(delta) change
+        if similar is not None:
+            with phase(timings, 'persist'):
+                model_artifacts.save(factorization, current_app.config['RECOMMENDER_MODEL_DIR'], similar=similar)
+
+        # TODO: recommend places near user with same category, location, high satisfaction for users with no visits
+        workers = current_app.config['RECOMMENDER_WORKERS']
+
+        if workers > 1 and users is None:
+            # Forked workers must not share the parent's pooled connections
+            db.session.remove()
+            db.engine.dispose()
+            shards = recommender.sharded_top_n(factorization.R, factorization.U, factorization.sigma, factorization.Vt,
+                                               factorization.user_index, factorization.item_index,
+                                               Recommendation.save_ranked, n=recommendations_per_day, users=users,
+                                               workers=workers, shard_size=current_app.config['RECOMMENDER_SHARD_SIZE'])
+            # Shards run in parallel, so these are seconds summed over workers
+            saved = 0
+            for shard_saved, shard_timings in shards:
+                saved += shard_saved
+                for name, seconds in shard_timings.items():
+                    timings[name] = timings.get(name, 0.0) + seconds
+        else:
+            with phase(timings, 'score'):
+                if users is None:
+                    R, U, user_ids = factorization.R, factorization.U, factorization.user_index
+                else:
+                    # Users touched by a fold-in are scored from their own rows, without assembling the whole matrix
+                    R, U, user_ids = factorization.rated(users), factorization.U[users], factorization.user_index[users]
+                top_items = recommender.top_n(R, U, factorization.sigma, factorization.Vt, n=recommendations_per_day)
+                ranked = [[factorization.item_index[item] for item in items if item >= 0] for items in top_items]
+            with phase(timings, 'persist'):
+                saved = Recommendation.save_ranked(user_ids, ranked)
+
+        if users is None:
+            Recommendation._scored_day = today
+
+        print("Saved {} recommendations ({})".format(
+            saved, ', '.join('{} {:.2f}s'.format(name, seconds) for name, seconds in timings.items())))
+        return saved
+
+
+class RecommendationRun(db.Model):
+    __tablename__ = 'recommendation_runs'
+
+    # Primary
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+
+    # Run
+    status = db.Column(db.String(16), nullable=False, default='running')
+    incremental = db.Column(db.Boolean, nullable=False, default=False)
+    host = db.Column(db.String(255), nullable=True)
+    visits_max_id = db.Column(db.Integer, nullable=True)
+    visits_max_created_at = db.Column(db.DateTime, nullable=True)
+    recommendations = db.Column(db.Integer, nullable=True)
+
+    # Phase timings in seconds
+    load_seconds = db.Column(db.Float, nullable=True)
+    factorize_seconds = db.Column(db.Float, nullable=True)
+    score_seconds = db.Column(db.Float, nullable=True)
+    persist_seconds = db.Column(db.Float, nullable=True)
+
+    # Metadata
+    started_at = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    PHASES = ['load', 'factorize', 'score', 'persist']
+
+    def __init__(self, watermark, incremental=False):
+        self.visits_max_id, self.visits_max_created_at = watermark
+        self.incremental = incremental
+        self.host = socket.gethostname()
+
+    def __repr__(self):
+        return str(self.to_json())
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'incremental': self.incremental,
+            'host': self.host,
+            'recommendations': self.recommendations,
+            'timings': {phase: getattr(self, phase + '_seconds') for phase in RecommendationRun.PHASES},
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+    def save(self):
+        try:
+            db.session.add(self)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise OperationException(self)
+
+    def finish(self, status, timings, recommendations=None):
+        # Sharded scoring resets the session, so reattach before updating
+        db.session.add(self)
+        self.status = status
+        self.recommendations = recommendations
+        for phase in RecommendationRun.PHASES:
+            setattr(self, phase + '_seconds', timings.get(phase))
+        self.finished_at = datetime.utcnow()
+        self.save()
+
+    @staticmethod
+    def get_latest_completed():
+        return RecommendationRun.query.filter(RecommendationRun.status == 'completed') \
+                                      .order_by(desc(RecommendationRun.started_at)).first()
+
+    @staticmethod
+    def count_by_status():
+        return db.session.query(RecommendationRun.status, func.count(RecommendationRun.id)) \
+                         .group_by(RecommendationRun.status).all()
+
+    @staticmethod
+    def is_current(watermark):
+        # Today's recommendations already cover every visit up to watermark
+        return db.session.query(RecommendationRun.query.filter(
+            RecommendationRun.status == 'completed',
+            RecommendationRun.started_at >= datetime.combine(datetime.utcnow().date(), datetime.min.time()),
+            RecommendationRun.visits_max_id == watermark[0],
+            RecommendationRun.visits_max_created_at == watermark[1],
+        ).exists()).scalar()
+
+
+class Business(db.Model):
+    __tablename__ = 'businesses'
+
+    # Primary
+    yelp_id = db.Column(db.String(128), primary_key=True)
+
+    # Projected Yelp fields
+    name = db.Column(db.String(256), nullable=True)
+    image_url = db.Column(db.String(512), nullable=True)
+    is_closed = db.Column(db.Boolean, nullable=True)
+    location = db.Column(JSONB, nullable=True)
+    url = db.Column(db.String(512), nullable=True)
+    price = db.Column(db.String(8), nullable=True)
+    categories = db.Column(JSONB, nullable=True)
+
+    # Metadata
+    # False for ids Yelp reports as not found, kept so refresh does not fetch them again until they are stale
+    found = db.Column(db.Boolean, nullable=False, default=True, server_default=text('true'))
+    fetched_at = db.Column(db.DateTime, index=True, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    FIELDS = ['name', 'image_url', 'is_closed', 'location', 'url', 'price', 'categories']
+
+    def __repr__(self):
+        return str(self.to_json())
+
+    def to_json(self, desired_props = []):
+        business = {'id': self.yelp_id, **{field: getattr(self, field) for field in Business.FIELDS}}
+        if desired_props:
+            return {desired_prop: business[desired_prop] for desired_prop in desired_props}
+        return business
+
+    @staticmethod
+    def get_many(yelp_ids, desired_props = []):
+        businesses = {business.yelp_id: business for business in Business.query.filter(Business.yelp_id.in_(yelp_ids), Business.found).all()} if yelp_ids else {}
+        return [businesses[yelp_id].to_json(desired_props) if yelp_id in businesses else None for yelp_id in yelp_ids]
+
+    @staticmethod
+    def refresh(batch_size=100, max_age=timedelta(days=7), timeout=60, scan_size=10000, max_ranges=10):
+        # Recommended ids always come from visits, so new yelp_ids are found by walking visits above a stored cursor,
+        # at most max_ranges ranges of scan_size ids per run; the stalest rows, not-found ones included, fill the rest
+        cursor = RefreshCursor.get(Business.__tablename__)
+        max_visit_id = db.session.query(func.max(Visit.id)).scalar() or 0
+        yelp_ids, ranges = [], []
+        while len(yelp_ids) < batch_size and cursor < max_visit_id and len(ranges) < max_ranges:
+            upper = min(cursor + scan_size, max_visit_id)
+            room = batch_size - len(yelp_ids)
+            missing = [yelp_id for yelp_id, in db.session.query(Visit.yelp_id)
+                       .outerjoin(Business, Business.yelp_id == Visit.yelp_id)
+                       .filter(Visit.id > cursor, Visit.id <= upper, Business.yelp_id.is_(None))
+                       .group_by(Visit.yelp_id)
+                       .order_by(func.min(Visit.id))
+                       .limit(room).all()]
+            yelp_ids += [yelp_id for yelp_id in missing if yelp_id not in yelp_ids]
+            # A range is complete when every missing id in it was selected
+            ranges.append((upper, missing, len(missing) < room))
+            cursor = upper
+
+        if len(yelp_ids) < batch_size:
+            stale = db.session.query(Business.yelp_id) \
+                              .filter(Business.fetched_at < datetime.utcnow() - max_age) \
+                              .order_by(Business.fetched_at) \
+                              .limit(batch_size - len(yelp_ids)).all()
+            yelp_ids += [yelp_id for yelp_id, in stale if yelp_id not in yelp_ids]
+
+        # Ids that time out or fail come back as None and are retried on a later run. Only the fields Yelp returned
+        # are written, so a partial response never blanks out what an earlier one stored
+        now = datetime.utcnow()
+        not_found = object()
+        responses = YelpFusion.get_many(yelp_ids, timeout=timeout, priority=BATCH, not_found=not_found) if yelp_ids else []
+        groups, resolved = {}, set()
+        for yelp_id, response in zip(yelp_ids, responses):
+            if response is not_found:
+                row = {'yelp_id': yelp_id, 'found': False}
+            elif response and 'error' not in response:
+                row = {'yelp_id': yelp_id, 'found': True, **{field: response[field] for field in Business.FIELDS if field in response}}
             else:
-                # TODO: recommend places near user with same category, location, high satisfaction
-                recommendations_for_today = []
+                continue
+            resolved.add(yelp_id)
+            row.update(fetched_at=now, created_at=now, updated_at=now)
+            groups.setdefault(tuple(row), []).append(row)
+
+        # The cursor passes a range only once all of its missing ids are stored
+        scanned = None
+        for upper, missing, complete in ranges:
+            if not complete or not resolved.issuperset(missing):
+                break
+            scanned = upper
 
-            return recommendations_for_today
+        try:
+            for columns, rows in groups.items():
+                statement = insert(Business.__table__).values(rows)
+                db.session.execute(statement.on_conflict_do_update(
+                    index_elements=[Business.yelp_id],
+                    set_={column: statement.excluded[column] for column in columns if column not in ('yelp_id', 'created_at')},
+                ))
+            if scanned is not None:
+                RefreshCursor.set(Business.__tablename__, scanned)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise OperationException()
+
+        return sum(len(rows) for rows in groups.values())
+
+
+class RefreshCursor(db.Model):
+    __tablename__ = 'refresh_cursors'
 
-        all_recommendations = []
-        for user_id in visit_history_df['user_id']:
-            all_recommendations += create_recommendations_with_user_id(user_id)
+    # Primary
+    name = db.Column(db.String(64), primary_key=True)
+
+    # Highest id a background job has fully processed
+    position = db.Column(db.Integer, nullable=False, default=0)
 
-        print("Starting batch save for {} recommendations.".format(len(all_recommendations)))
+    # Metadata
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-        start = datetime.utcnow()
-        Recommendation.batch_save(all_recommendations)
-        end = datetime.utcnow()
+    @staticmethod
+    def get(name):
+        return db.session.query(RefreshCursor.position).filter(RefreshCursor.name == name).scalar() or 0
 
-        print("Insert operation took {} seconds".format((end - start).seconds))
+    @staticmethod
+    def set(name, position):
+        # Joins the caller's transaction, so the cursor moves together with the rows it covers
+        statement = insert(RefreshCursor.__table__).values(name=name, position=position, updated_at=datetime.utcnow())
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[RefreshCursor.name],
+            set_={'position': statement.excluded.position, 'updated_at': statement.excluded.updated_at},
+        ))
@@ -1,4 +1,18 @@
-from flask import jsonify
+from flask import Response, current_app, request
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+import codecs
+import gzip
+import hashlib
+import json
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from scout.lib.serialization import encode_envelope, get_serializer
 
 def execute_with_default(f, default, exception = Exception):
     def wrap(*args, **kwargs):
@@ -9,4 +23,120 @@ def execute_with_default(f, default, exception = Exception):
     return wrap
 
 def compose_json_response(success, data, message, code):
-    return jsonify({'success': success,'data': data,'message': message}), code
\ No newline at end of file
+    body = encode_envelope(success, data, message, get_serializer(current_app.config['JSON_SERIALIZER']))
+    return Response(body, mimetype='application/json'), code
+
+def make_etag(*parts):
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode('utf8')).hexdigest()
+
+def is_fresh(etag):
+    return request.if_none_match.contains_weak(etag)
+
+def set_validators(response, etag):
+    # Weak, because the same representation may be sent gzip, br or uncompressed
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Accept-Encoding')
+    return response
+
+def not_modified(etag):
+    return set_validators(Response(status=304), etag)
+
+def compress_response(response):
+    # after_request hook: compresses large JSON bodies with the best encoding the client accepts
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers:
+        return response
+
+    body = response.get_data()
+    if len(body) < current_app.config['COMPRESSION_MIN_SIZE']:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    if encoding == 'br':
+        response.set_data(brotli.compress(body, quality=current_app.config['COMPRESSION_BROTLI_QUALITY']))
+    elif encoding == 'gzip':
+        response.set_data(gzip.compress(body, compresslevel=current_app.config['COMPRESSION_GZIP_LEVEL']))
+    else:
+        return response
+
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def encode_cursor(created_at, id):
+    return urlsafe_b64encode('{}|{}'.format(created_at.isoformat(), id).encode('utf8')).decode('ascii')
+
+def decode_cursor(cursor):
+    # Raises ValueError for anything encode_cursor did not produce
+    try:
+        created_at, id = urlsafe_b64decode(cursor.encode('ascii')).decode('utf8').split('|')
+        return datetime.strptime(created_at, '%Y-%m-%dT%H:%M:%S.%f' if '.' in created_at else '%Y-%m-%dT%H:%M:%S'), int(id)
+    except (TypeError, UnicodeError, ValueError) as e:
+        raise ValueError('Invalid cursor') from e
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER_CHARS = frozenset('0123456789+-.eE')
+_LITERALS = ('true', 'false', 'null', 'NaN', 'Infinity', '-Infinity')
+
+def _may_continue(buffer, start):
+    # Whether the unparsed end of the buffer could be the start of a number or literal cut at a chunk boundary
+    tail = buffer[start:] if len(buffer) - start <= 16 else None
+    return tail is not None and (all(char in _NUMBER_CHARS for char in tail) or any(literal.startswith(tail) for literal in _LITERALS))
+
+def iter_json_array(stream, chunk_size=64 * 1024, max_element_size=1024 * 1024):
+    # Yields the elements of a JSON array read from a byte stream, holding about one element in memory at a time.
+    # An element is taken only once the input after it shows it is complete, and a malformed one fails right away
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf8')()
+    buffer, pos, eof = '', 0, False
+    expected = '['
+
+    while True:
+        pos = _WHITESPACE.match(buffer, pos).end()
+        if pos < len(buffer):
+            char = buffer[pos]
+            if expected == '[':
+                if char != '[':
+                    raise ValueError('Expected a JSON array')
+                expected, pos = 'first', pos + 1
+                continue
+            if expected == 'separator' or (expected == 'first' and char == ']'):
+                if char == ']':
+                    return
+                if char != ',':
+                    raise ValueError("Expected ',' or ']' between array elements")
+                expected, pos = 'value', pos + 1
+                continue
+
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                truncated = e.pos >= len(buffer) or e.msg.startswith(('Unterminated string', 'Invalid \\uXXXX')) or _may_continue(buffer, e.pos)
+                if eof or not truncated:
+                    raise ValueError('Invalid JSON array element: {}'.format(e.msg)) from e
+            else:
+                if eof or not _may_continue(buffer, end):
+                    expected, pos = 'separator', end
+                    yield value
+                    continue
+
+            if len(buffer) - pos > max_element_size:
+                raise ValueError('JSON array element too large')
+
+        if eof:
+            raise ValueError('Unterminated JSON array')
+        # The consumed part is dropped once per chunk rather than once per element
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer, pos = buffer[pos:] + utf8.decode(chunk, final=eof), 0
+
+def iter_ndjson(stream):
+    # Yields one parsed value per non-empty line; lines that fail to parse yield the ValueError instead
+    for line in stream:
+        if line.strip():
+            try:
+                yield json.loads(line.decode('utf8') if isinstance(line, bytes) else line)
+            except ValueError as e:
+                yield e